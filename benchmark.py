@@ -0,0 +1,435 @@
+"""
+Load/benchmark suite for every endpoint group and both websockets.
+
+In-process (the app runs inside this process on a fresh temporary database):
+python benchmark.py --requests 500 --concurrency 32 --output results.json
+Against a running server (start it with IMAGE_FAILURE_PERCENT=0 IMAGE_DELAY_PERCENT=0 IMAGE_FEED_INTERVAL=0.1,
+websocket scenarios additionally need the `websockets` package):
+python benchmark.py --url http://localhost:8081 --output results.json
+Compare with a previous run (exits with 1 if p95 or throughput of a scenario got worse by more than --threshold %):
+python benchmark.py --compare previous.json
+
+Every scenario reports p50/p95/p99 latency, throughput and memory (RSS delta of this process,
+so only meaningful in-process; --trace-memory adds the tracemalloc peak, at the cost of slower runs).
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import AsyncExitStack
+import httpx
+import numpy as np
+
+
+# ------------------------------- websocket clients ------------------------------- #
+class AsgiWebSocket:
+    """Minimal websocket client speaking ASGI directly to the app (httpx has no websocket support)."""
+
+    def __init__(self, app, path):
+        self.app = app
+        self.path = path
+        self._to_app = asyncio.Queue()
+        self._from_app = asyncio.Queue()
+        self._task = None
+
+    async def connect(self):
+        path, _, query = self.path.partition("?")
+        scope = {
+            "type": "websocket", "asgi": {"version": "3.0"}, "scheme": "ws", "http_version": "1.1",
+            "path": path, "raw_path": path.encode(), "root_path": "", "query_string": query.encode(),
+            "headers": [(b"host", b"benchmark")], "client": ("benchmark", 0), "server": ("benchmark", 80),
+            "subprotocols": [], "state": {},
+        }
+        self._task = asyncio.create_task(self.app(scope, self._to_app.get, self._from_app.put))
+        await self._to_app.put({"type": "websocket.connect"})
+        message = await self._from_app.get()
+        if message["type"] != "websocket.accept":
+            raise ConnectionError(f"Websocket {self.path} rejected: {message}")
+        return self
+
+    async def send_text(self, text):
+        await self._to_app.put({"type": "websocket.receive", "text": text})
+
+    async def receive_text(self):
+        message = await self._from_app.get()
+        if message["type"] == "websocket.close":
+            raise ConnectionError(f"Websocket {self.path} closed")
+        return message["text"]
+
+    async def close(self):
+        await self._to_app.put({"type": "websocket.disconnect", "code": 1000})
+        await asyncio.wait_for(self._task, 5)
+
+
+class RemoteWebSocket:
+    def __init__(self, base_url, path):
+        self.url = base_url.replace("http", "ws", 1).rstrip("/") + path
+        self._socket = None
+
+    async def connect(self):
+        import websockets  # optional, only needed against a remote server
+        self._socket = await websockets.connect(self.url, max_queue=None)
+        return self
+
+    async def send_text(self, text):
+        await self._socket.send(text)
+
+    async def receive_text(self):
+        return await self._socket.recv()
+
+    async def close(self):
+        await self._socket.close()
+
+
+# ----------------------------------- measuring ----------------------------------- #
+def rss_mb():
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except (OSError, ValueError):
+        return None
+
+
+def summarize(latencies, errors, seconds):
+    result = {"count": len(latencies), "errors": errors, "seconds": seconds,
+              "throughput_per_second": len(latencies) / seconds if seconds else None}
+    if latencies:
+        ms = np.array(latencies) * 1000
+        result.update({"mean_ms": float(ms.mean()), "max_ms": float(ms.max()),
+                       **{f"p{p}_ms": float(np.percentile(ms, p)) for p in (50, 95, 99)}})
+    return result
+
+
+async def run_requests(call, requests, concurrency):
+    """Runs call(i) for i in range(requests) on `concurrency` concurrent workers."""
+    latencies = []
+    errors = 0
+    indices = iter(range(requests))
+
+    async def worker():
+        nonlocal errors
+        for i in indices:
+            started = time.perf_counter()
+            try:
+                await call(i)
+            except Exception:
+                errors += 1
+                continue
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latencies, errors, time.perf_counter() - started
+
+
+class Fanout:
+    """Tracks when each message has been received by all expected clients."""
+
+    def __init__(self, expected):
+        self.expected = expected
+        self._pending = {}
+        self.first_seen = {}
+
+    def expect(self, key):
+        self._pending[key] = [self.expected, asyncio.Event()]
+        return self._pending[key][1]
+
+    def received(self, key):
+        """Returns True when the last expected client got the message."""
+        self.first_seen.setdefault(key, time.perf_counter())
+        pending = self._pending.setdefault(key, [self.expected, asyncio.Event()])
+        pending[0] -= 1
+        if pending[0] == 0:
+            pending[1].set()
+            return True
+        return False
+
+
+async def read_forever(socket, on_message):
+    try:
+        while True:
+            on_message(await socket.receive_text())
+    except (ConnectionError, asyncio.CancelledError):
+        pass
+    except Exception:
+        pass  # remote socket closed
+
+
+# ----------------------------------- scenarios ----------------------------------- #
+class Benchmark:
+    def __init__(self, client, open_websocket, args):
+        self.client = client
+        self.open_websocket = open_websocket
+        self.args = args
+        self.rng = random.Random(args.seed)
+
+    def book_id(self):
+        return self.rng.randint(1, self.args.books)
+
+    def user_id(self):
+        return self.rng.randint(1, self.args.users)
+
+    def image_id(self):
+        return self.rng.randint(1, self.args.images)
+
+    async def get(self, url, **kwargs):
+        (await self.client.get(url, **kwargs)).raise_for_status()
+
+    async def send(self, method, url, **kwargs):
+        response = await self.client.request(method, url, **kwargs)
+        response.raise_for_status()
+        return response
+
+    @staticmethod
+    def new_book(i):
+        return {"title": f"Benchmark book {i}", "author": "Bench Mark", "description": "benchmark", "rating": i % 101}
+
+    def new_image(self, i):
+        return {"title": f"benchmark {i}", "user_id": 1, "description": "benchmark",
+                "rectangles": [{"x": self.rng.randint(0, 100), "y": self.rng.randint(0, 100),
+                                "width": self.rng.randint(1, 200), "height": self.rng.randint(1, 200),
+                                "color": "white"} for _ in range(self.rng.randint(1, 10))],
+                "tags": self.rng.sample(["river", "shadow", "garden", "winter", "benchmark"], 2)}
+
+    def http_scenarios(self):
+        created_images = []
+
+        async def prepare_deletes():
+            response = await self.send("POST", "/images/batch",
+                                       json=[self.new_image(i) for i in range(self.args.requests)])
+            created_images.extend(response.json()["ids"])
+
+        return {
+            # CRUD
+            "books_list": (None, lambda i: self.get("/", params={"limit": 100, "after": self.book_id()})),
+            "books_create": (None, lambda i: self.send("POST", "/", json=self.new_book(i))),
+            "books_update": (None, lambda i: self.send("PUT", f"/{self.book_id()}", json=self.new_book(i))),
+            "users_list": (None, lambda i: self.get("/users", params={"limit": 100})),
+            "users_create": (None, lambda i: self.send("POST", "/users", json={
+                "username": f"bench{i}", "email": f"bench{i}@example.com", "password": "benchmark"})),
+            # reviews and their aggregation
+            "book_reviews_list": (None, lambda i: self.get(f"/book_reviews/{self.book_id()}")),
+            "user_reviews_list": (None, lambda i: self.get(f"/user_reviews/{self.user_id()}")),
+            "review_create": (None, lambda i: self.send("POST", f"/book_reviews/{self.book_id()}/{self.user_id()}",
+                                                        json={"review": "benchmark", "rating": i % 101})),
+            "review_batch_create": (None, lambda i: self.send("POST", "/book_reviews/batch", json=[
+                {"book_id": self.book_id(), "user_id": self.user_id(), "review": "benchmark", "rating": j % 101}
+                for j in range(1000)])),
+            "average_rating": (None, lambda i: self.get(f"/book_reviews/{self.book_id()}/average_rating")),
+            "rating_stats": (None, lambda i: self.get("/book_rating_stats", params={
+                "book_ids": [self.book_id() for _ in range(50)]})),
+            "search_books": (None, lambda i: self.get("/search", params={"q": "wizard river", "limit": 20})),
+            "search_reviews": (None, lambda i: self.get("/search", params={"q": "dragon*", "type": "reviews",
+                                                                          "limit": 20})),
+            # images and tags
+            "image_get": (None, lambda i: self.get(f"/images/{self.image_id()}")),
+            "images_fetch": (None, lambda i: self.send("POST", "/images/fetch", json={
+                "ids": [self.image_id() for _ in range(100)], "fields": ["title", "tags"]})),
+            "image_render": (None, lambda i: self.get(f"/images/{self.image_id()}/render", params={"w": 256})),
+            "image_thumbnails": (None, lambda i: self.send("POST", "/images/thumbnails", json={
+                "ids": [self.image_id() for _ in range(50)], "w": 64})),
+            "images_list": (None, lambda i: self.get("/images", params={"limit": 100, "after": self.image_id()})),
+            "images_by_tags": (None, lambda i: self.get("/images", params={"tags": ["river", "shadow"]})),
+            "images_spatial_point": (None, lambda i: self.get("/images/spatial/point", params={
+                "x": self.rng.randint(0, 300), "y": self.rng.randint(0, 300)})),
+            "tags_list": (None, lambda i: self.get("/tags")),
+            "tags_stats": (None, lambda i: self.get("/tags/stats", params={"limit": 20})),
+            "tags_related": (None, lambda i: self.get("/tags/river/related", params={"limit": 20})),
+            "image_create": (None, lambda i: self.send("POST", "/images", json=self.new_image(i))),
+            "image_batch_create": (None, lambda i: self.send("POST", "/images/batch",
+                                                             json=[self.new_image(j) for j in range(100)])),
+            "image_delete": (prepare_deletes, lambda i: self.send("DELETE", f"/images/{created_images[i]}")),
+        }
+
+    async def ws_chat_fanout(self):
+        """One client talks on /ws/{client_id}, latency = until every connected client got the message."""
+        query = "?batch=true" if self.args.ws_batch else ""
+        clients = [await self.open_websocket(f"/ws/{i}{query}").connect() for i in range(self.args.ws_clients)]
+        fanout = Fanout(len(clients))
+
+        def on_message(text):
+            # coalesced frames are JSON arrays of messages, chat messages never start with "["
+            for message in json.loads(text) if text.startswith("[") else [text]:
+                if " says: " in message:
+                    fanout.received(message.split(" says: ", 1)[1])
+
+        readers = [asyncio.create_task(read_forever(client, on_message)) for client in clients]
+
+        async def send(i):
+            delivered = fanout.expect(f"bench-{i}")
+            await clients[0].send_text(f"bench-{i}")
+            await asyncio.wait_for(delivered.wait(), self.args.timeout)
+
+        try:
+            # sequential, otherwise the latency of one message includes waiting behind the others
+            return await run_requests(send, self.args.requests, 1)
+        finally:
+            for reader in readers:
+                reader.cancel()
+            for client in clients:
+                await client.close()
+
+    async def ws_image_feed(self):
+        """Subscribers of /ws, latency = from the first to the last subscriber receiving the same image id."""
+        clients = [await self.open_websocket("/ws").connect() for _ in range(self.args.ws_clients)]
+        fanout = Fanout(len(clients))
+        complete = []
+        all_done = asyncio.Event()
+
+        def on_message(text):
+            if fanout.received(text):
+                complete.append(time.perf_counter() - fanout.first_seen[text])
+                if len(complete) >= self.args.feed_messages:
+                    all_done.set()
+
+        readers = [asyncio.create_task(read_forever(client, on_message)) for client in clients]
+        started = time.perf_counter()
+        errors = 0
+        try:
+            await asyncio.wait_for(all_done.wait(), self.args.timeout * self.args.feed_messages)
+        except asyncio.TimeoutError:
+            errors = self.args.feed_messages - len(complete)
+        seconds = time.perf_counter() - started
+        for reader in readers:
+            reader.cancel()
+        for client in clients:
+            await client.close()
+        return complete, errors, seconds
+
+    async def run(self, only=None):
+        results = {}
+        scenarios = {name: (prepare, call) for name, (prepare, call) in self.http_scenarios().items()}
+        scenarios["ws_chat_fanout"] = (None, None)
+        scenarios["ws_image_feed"] = (None, None)
+        for name, (prepare, call) in scenarios.items():
+            if only and name not in only:
+                continue
+            if prepare is not None:
+                await prepare()
+            if self.args.trace_memory:
+                tracemalloc.start()
+            rss_before = rss_mb()
+            try:
+                if name == "ws_chat_fanout":
+                    latencies, errors, seconds = await self.ws_chat_fanout()
+                elif name == "ws_image_feed":
+                    latencies, errors, seconds = await self.ws_image_feed()
+                else:
+                    latencies, errors, seconds = await run_requests(call, self.args.requests, self.args.concurrency)
+            except ImportError as e:
+                print(f"{name:22} skipped ({e})")
+                continue
+            result = summarize(latencies, errors, seconds)
+            rss_after = rss_mb()
+            result["rss_mb"] = rss_after
+            result["rss_delta_mb"] = rss_after - rss_before if rss_after is not None and rss_before is not None else None
+            if self.args.trace_memory:
+                result["traced_peak_mb"] = tracemalloc.get_traced_memory()[1] / 2 ** 20
+                tracemalloc.stop()
+            results[name] = result
+            print(format_result(name, result))
+        return results
+
+
+def format_result(name, result):
+    if not result["count"]:
+        return f"{name:22} no successful requests ({result['errors']} errors)"
+    return (f"{name:22} p50 {result['p50_ms']:8.2f} ms  p95 {result['p95_ms']:8.2f} ms  p99 {result['p99_ms']:8.2f} ms"
+            f"  {result['throughput_per_second']:9.1f}/s  errors {result['errors']}")
+
+
+def compare(previous, current, threshold):
+    """Prints the change of p95 and throughput per scenario, returns the names of regressed scenarios."""
+    regressions = []
+    for name, now in current["scenarios"].items():
+        before = previous.get("scenarios", {}).get(name)
+        if not before or not before.get("count") or not now.get("count"):
+            continue
+        p95_change = (now["p95_ms"] / before["p95_ms"] - 1) * 100 if before["p95_ms"] else 0
+        throughput_change = (now["throughput_per_second"] / before["throughput_per_second"] - 1) * 100
+        regressed = p95_change > threshold or throughput_change < -threshold
+        if regressed:
+            regressions.append(name)
+        print(f"{name:22} p95 {p95_change:+7.1f}%  throughput {throughput_change:+7.1f}%{'  REGRESSION' if regressed else ''}")
+    return regressions
+
+
+# ------------------------------------- main -------------------------------------- #
+async def benchmark(args):
+    async with AsyncExitStack() as stack:
+        if args.url:
+            client = await stack.enter_async_context(httpx.AsyncClient(base_url=args.url, timeout=args.timeout))
+            open_websocket = lambda path: RemoteWebSocket(args.url, path)
+        else:
+            # must be set before the app (and its database configuration) is imported
+            os.environ.setdefault("DATABASE_URL", f"sqlite:///{tempfile.mkdtemp()}/benchmark.db")
+            os.environ.setdefault("IMAGE_FAILURE_PERCENT", "0")
+            os.environ.setdefault("IMAGE_DELAY_PERCENT", "0")
+            os.environ.setdefault("IMAGE_FEED_INTERVAL", "0.1")
+            import server
+            await stack.enter_async_context(server.lifespan(server.app))
+            client = await stack.enter_async_context(httpx.AsyncClient(
+                transport=httpx.ASGITransport(app=server.app), base_url="http://benchmark", timeout=args.timeout))
+            open_websocket = lambda path: AsgiWebSocket(server.app, path)
+
+        if args.generate:
+            print("Generating the dataset...")
+            response = await client.post("/seed-database/generate", params={
+                "users": args.users, "books": args.books, "reviews": args.reviews,
+                "tags": args.tags, "images": args.images, "seed": args.seed}, timeout=None)
+            response.raise_for_status()
+
+        only = set(args.scenarios.split(",")) if args.scenarios else None
+        scenarios = await Benchmark(client, open_websocket, args).run(only)
+
+    return {
+        "meta": {
+            "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "target": args.url or "in-process",
+            "requests": args.requests, "concurrency": args.concurrency, "ws_clients": args.ws_clients,
+            "dataset": {"users": args.users, "books": args.books, "reviews": args.reviews,
+                        "tags": args.tags, "images": args.images, "seed": args.seed},
+            "python": sys.version.split()[0],
+        },
+        "scenarios": scenarios,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the API and websockets")
+    parser.add_argument("--url", help="benchmark a running server instead of an in-process app")
+    parser.add_argument("--requests", type=int, default=200, help="requests (or messages) per scenario")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--ws-clients", type=int, default=50, help="connected clients in the websocket scenarios")
+    parser.add_argument("--ws-batch", action="store_true", help="chat clients receive coalesced frames")
+    parser.add_argument("--feed-messages", type=int, default=20, help="image ids to wait for on /ws")
+    parser.add_argument("--timeout", type=float, default=30)
+    parser.add_argument("--scenarios", help="comma separated subset of scenarios to run")
+    parser.add_argument("--no-generate", dest="generate", action="store_false", help="use the existing data")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--books", type=int, default=1000)
+    parser.add_argument("--reviews", type=int, default=20000)
+    parser.add_argument("--tags", type=int, default=200)
+    parser.add_argument("--images", type=int, default=5000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--trace-memory", action="store_true")
+    parser.add_argument("--output", help="write the results as JSON")
+    parser.add_argument("--compare", help="results JSON of a previous run")
+    parser.add_argument("--threshold", type=float, default=10, help="regression threshold in %%")
+    args = parser.parse_args()
+
+    results = asyncio.run(benchmark(args))
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=2)
+    if args.compare:
+        with open(args.compare) as previous:
+            regressed = compare(json.load(previous), results, args.threshold)
+        if regressed:
+            sys.exit(1)
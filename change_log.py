@@ -0,0 +1,107 @@
+import asyncio
+import os
+import threading
+from collections import deque
+from contextlib import suppress
+from sqlalchemy import select, func
+import models
+from database import on_commit, insert_returning_keys
+
+# ------------------------- Image change log ------------------------- #
+# Every image write appends (seq, image_id, op) rows to image_changes in the same transaction, so a client
+# that remembers the last seq it has seen only needs the changes after it (GET /images/changes?since=seq).
+# Writes are serialized by SQLite, so the sequence numbers grow in commit order without gaps
+# (a rolled back write takes its sequence numbers with it).
+# The most recent changes are also kept in memory: websocket subscribers are woken up after every commit and
+# read the new changes from there instead of querying the database each. Only the changes of this process
+# get there, so memory is trusted for the contiguous range it holds and whatever comes after it (changes of
+# other processes) is still read from the database.
+INSERT, UPDATE, DELETE = "insert", "update", "delete"
+CHANGE_FEED_BUFFER = int(os.environ.get("CHANGE_FEED_BUFFER", 10000))
+# changes committed by other processes aren't in memory, subscribers check the database this often
+CHANGE_FEED_POLL_INTERVAL = float(os.environ.get("CHANGE_FEED_POLL_INTERVAL", 1))
+
+changes_table = models.ImageChanges.__table__
+
+
+def to_dict(seq, image_id, op):
+    return {"seq": seq, "image_id": image_id, "op": op}
+
+
+def record_changes(db, image_ids, op, feed=None):
+    """Logs `op` for every image (in the caller's transaction); the feed gets them after the commit."""
+    if not image_ids:
+        return
+    seqs = insert_returning_keys(db, changes_table, changes_table.c.seq,
+                                 [{"image_id": image_id, "op": op} for image_id in image_ids])
+    if feed is not None:
+        changes = [to_dict(seq, image_id, op) for seq, image_id in zip(seqs, image_ids)]
+        on_commit(db, lambda: feed.append(changes))
+
+
+def list_changes(db, since, limit):
+    rows = db.execute(select(changes_table.c.seq, changes_table.c.image_id, changes_table.c.op)
+                      .where(changes_table.c.seq > since).order_by(changes_table.c.seq).limit(limit))
+    return [to_dict(*row) for row in rows]
+
+
+def last_seq(db):
+    return db.execute(select(func.max(changes_table.c.seq))).scalar() or 0
+
+
+class ChangeFeed:
+    def __init__(self, size=CHANGE_FEED_BUFFER):
+        self._recent = deque(maxlen=size)
+        self._head = 0  # highest seq known to be committed
+        self._others_head = 0  # highest seq known to be written by another process
+        self._lock = threading.Lock()
+        self._loop = None
+        self._committed = asyncio.Event()
+
+    def reset(self, head):
+        with self._lock:
+            self._recent.clear()
+            self._head = head
+
+    def append(self, changes):
+        # called by the writer thread after the commit, in commit order
+        with self._lock:
+            if changes[0]["seq"] != self._head + 1:
+                # another process wrote in between, only contiguous changes can be served from memory
+                self._recent.clear()
+                self._others_head = changes[0]["seq"] - 1
+            self._recent.extend(changes)
+            self._head = changes[-1]["seq"]
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._notify)
+
+    @property
+    def head(self):
+        return self._head
+
+    def others_head(self, latest):
+        """Highest seq written by another process as far as known, `latest` = the last seq in the database."""
+        with self._lock:
+            return max(self._others_head, latest if latest > self._head else 0)
+
+    def after(self, since, limit):
+        """Changes after `since` held in memory, None when `since` is outside of them (read the database then).
+        A result shorter than `limit` ends at the last change of this process, newer ones may be in the database."""
+        with self._lock:
+            if not self._recent or not self._recent[0]["seq"] - 1 <= since < self._head:
+                return None
+            start = since + 1 - self._recent[0]["seq"]
+            return [self._recent[i] for i in range(start, min(start + limit, len(self._recent)))]
+
+    async def wait(self, timeout=CHANGE_FEED_POLL_INTERVAL):
+        """Waits for the next commit of this process, False after the timeout."""
+        self._loop = asyncio.get_running_loop()
+        with suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(self._committed.wait(), timeout)
+            return True
+        return False
+
+    def _notify(self):
+        # wakes everybody waiting for the current event, later waiters get a fresh one
+        self._committed.set()
+        self._committed = asyncio.Event()
@@ -0,0 +1,178 @@
+import asyncio
+import json
+import os
+import time
+import metrics
+
+# ------------------------ websocket connection manager ------------------------ #
+# Every connection gets a bounded outbound queue drained by its own writer task, so broadcast()
+# only enqueues and one slow client can't hold up the message for everybody else.
+# When a client's queue is full, the slow-consumer policy decides what happens:
+#   drop_oldest - the oldest pending message of that client is discarded
+#   disconnect  - the client is disconnected (close code 1008)
+DROP_OLDEST = "drop_oldest"
+DISCONNECT = "disconnect"
+SLOW_CONSUMER_POLICIES = (DROP_OLDEST, DISCONNECT)
+
+WS_MAX_PENDING = int(os.environ.get("WS_MAX_PENDING", 256))
+WS_SLOW_CONSUMER_POLICY = os.environ.get("WS_SLOW_CONSUMER_POLICY", DROP_OLDEST)
+
+# Clients connected with batch=True get their messages coalesced: after the first pending message the writer
+# waits WS_BATCH_WINDOW_MS for more and sends everything pending (up to WS_BATCH_MAX_MESSAGES) as one
+# JSON array frame. Fewer frames = fewer syscalls and less per-frame overhead at high message rates,
+# for at most the window of extra latency. (permessage-deflate is negotiated by the server, e.g. uvicorn's
+# --ws-per-message-deflate, on by default; a JSON array of similar messages compresses well.)
+WS_BATCH_WINDOW = float(os.environ.get("WS_BATCH_WINDOW_MS", 10)) / 1000
+WS_BATCH_MAX_MESSAGES = int(os.environ.get("WS_BATCH_MAX_MESSAGES", 100))
+
+ws_send_latency = metrics.Histogram("ws_send_duration_seconds", "Time from enqueueing a websocket message until it "
+                                    "was sent (queueing + send)", ("manager",))
+ws_dropped = metrics.Counter("ws_messages_dropped_total", "Messages dropped for slow consumers", ("manager",))
+ws_kicked = metrics.Counter("ws_slow_consumers_disconnected_total", "Slow consumers disconnected", ("manager",))
+ws_messages_sent = metrics.Counter("ws_messages_sent_total", "Messages sent", ("manager",))
+ws_frames_sent = metrics.Counter("ws_frames_sent_total", "Frames sent (frames per message = frames / messages)",
+                                 ("manager",))
+ws_batched_bytes = metrics.Counter("ws_batched_frame_bytes_total", "Bytes of the coalesced frames sent to batching "
+                                   "clients, payload + frame header", ("manager",))
+ws_unbatched_bytes = metrics.Counter("ws_unbatched_frame_bytes_total", "Bytes the same messages would have taken "
+                                     "as one frame each (bytes saved = this - ws_batched_frame_bytes_total)",
+                                     ("manager",))
+managers = []
+
+
+def frame_size(payload_length):
+    # unmasked server -> client frame: 2 bytes of header, + 2 or 8 bytes of extended length
+    return payload_length + (2 if payload_length < 126 else 4 if payload_length < 1 << 16 else 10)
+
+
+def collect_websocket_metrics():
+    # read at scrape time, nothing to maintain on the hot path
+    lines = ["# HELP ws_connections Open websocket connections", "# TYPE ws_connections gauge"]
+    lines.extend(f'ws_connections{{manager="{m.name}"}} {len(m.active_connections)}' for m in managers)
+    lines += ["# HELP ws_queue_depth Messages waiting in the outbound queues", "# TYPE ws_queue_depth gauge"]
+    depths = {m.name: m.queue_depths() for m in managers}
+    lines.extend(f'ws_queue_depth{{manager="{name}"}} {sum(d)}' for name, d in depths.items())
+    lines += ["# HELP ws_max_queue_depth Longest outbound queue of a single client",
+              "# TYPE ws_max_queue_depth gauge"]
+    lines.extend(f'ws_max_queue_depth{{manager="{name}"}} {max(d, default=0)}' for name, d in depths.items())
+    return lines
+
+
+metrics.register_collector(collect_websocket_metrics)
+
+
+class Client:
+    __slots__ = ("websocket", "queue", "writer", "dropped", "batch")
+
+    def __init__(self, websocket, max_pending, batch=False):
+        self.websocket = websocket
+        self.queue = asyncio.Queue(maxsize=max_pending)
+        self.writer = None
+        self.dropped = 0
+        self.batch = batch
+
+
+class ConnectionManager:
+    def __init__(self, name="default", max_pending=WS_MAX_PENDING, slow_consumer_policy=WS_SLOW_CONSUMER_POLICY,
+                 broker=None, batch_window=WS_BATCH_WINDOW, batch_max_messages=WS_BATCH_MAX_MESSAGES):
+        if slow_consumer_policy not in SLOW_CONSUMER_POLICIES:
+            raise ValueError(f"Unknown slow consumer policy {slow_consumer_policy!r}")
+        self.name = name  # metrics label and pub/sub channel
+        # broadcasts are forwarded to the managers of the same name in the other processes (see pubsub.py)
+        self.broker = broker
+        if broker is not None:
+            broker.subscribe(name, self.deliver)
+        self.max_pending = max_pending
+        self.batch_window = batch_window
+        self.batch_max_messages = batch_max_messages
+        self.slow_consumer_policy = slow_consumer_policy
+        self.active_connections = {}  # websocket -> Client
+        self._closing = set()  # keeps references to pending close() tasks
+        managers.append(self)
+
+    def queue_depths(self):
+        return [client.queue.qsize() for client in list(self.active_connections.values())]
+
+    async def connect(self, websocket, batch=False):
+        await websocket.accept()
+        client = Client(websocket, self.max_pending, batch)
+        client.writer = asyncio.create_task(self._write_batches(client) if batch else self._write(client))
+        self.active_connections[websocket] = client
+
+    def disconnect(self, websocket):
+        # safe to call more than once (e.g. by the endpoint after the manager already dropped the client)
+        client = self.active_connections.pop(websocket, None)
+        if client is not None and client.writer is not asyncio.current_task():
+            client.writer.cancel()
+
+    async def send_personal_message(self, message, websocket):
+        client = self.active_connections.get(websocket)
+        if client is not None:
+            self._enqueue(client, message)
+
+    async def broadcast(self, message):
+        self.deliver(message)
+        if self.broker is not None:
+            await self.broker.publish(self.name, message)
+
+    def deliver(self, message):
+        # to the clients of this process only; never blocks, the writer tasks do the actual sending
+        for client in list(self.active_connections.values()):
+            self._enqueue(client, message)
+
+    def _enqueue(self, client, message):
+        if client.queue.full():
+            if self.slow_consumer_policy == DISCONNECT:
+                self._kick(client)
+                return
+            client.queue.get_nowait()
+            client.dropped += 1
+            ws_dropped.inc(self.name)
+        client.queue.put_nowait((time.perf_counter(), message))
+
+    def _kick(self, client):
+        ws_kicked.inc(self.name)
+        self.disconnect(client.websocket)
+        task = asyncio.create_task(self._close(client.websocket))
+        self._closing.add(task)
+        task.add_done_callback(self._closing.discard)
+
+    @staticmethod
+    async def _close(websocket):
+        try:
+            await websocket.close(code=1008, reason="slow consumer")
+        except Exception:
+            pass  # already gone
+
+    async def _write(self, client):
+        try:
+            while True:
+                enqueued, message = await client.queue.get()
+                await client.websocket.send_text(message)
+                ws_send_latency.observe(self.name, value=time.perf_counter() - enqueued)
+                ws_messages_sent.inc(self.name)
+                ws_frames_sent.inc(self.name)
+        except Exception:
+            # the socket is closed, the endpoint will notice it on its next receive
+            self.disconnect(client.websocket)
+
+    async def _write_batches(self, client):
+        try:
+            while True:
+                batch = [await client.queue.get()]
+                if self.batch_window > 0:
+                    await asyncio.sleep(self.batch_window)
+                while len(batch) < self.batch_max_messages and not client.queue.empty():
+                    batch.append(client.queue.get_nowait())
+                messages = [message for _, message in batch]
+                payload = json.dumps(messages)
+                await client.websocket.send_text(payload)
+                sent = time.perf_counter()
+                for enqueued, _ in batch:
+                    ws_send_latency.observe(self.name, value=sent - enqueued)
+                ws_messages_sent.inc(self.name, amount=len(batch))
+                ws_frames_sent.inc(self.name)
+                ws_batched_bytes.inc(self.name, amount=frame_size(len(payload.encode())))
+                ws_unbatched_bytes.inc(self.name, amount=sum(frame_size(len(m.encode())) for m in messages))
+        except Exception:
+            self.disconnect(client.websocket)
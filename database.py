@@ -1,11 +1,199 @@
-from sqlalchemy import create_engine
+import asyncio
+import contextvars
+import logging
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future
+from sqlalchemy import create_engine, event, insert
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 
-# ------------------- Database Configuration [DON'T TOUCH] ------------------- # 
-SQLALCHEMY_DATABASE_URL = "sqlite:///./database.db"
-engine = create_engine(
-    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
-)
+# ------------------- Database Configuration ------------------- #
+# Everything can be overridden from the environment, the defaults are the production profile for SQLite:
+# WAL journal (readers don't block the writer and vice versa), synchronous=NORMAL (safe with WAL,
+# no fsync per commit), a 64 MiB page cache and 256 MiB of memory-mapped I/O per connection.
+SQLALCHEMY_DATABASE_URL = os.environ.get("DATABASE_URL", "sqlite:///./database.db")
+SQLITE_JOURNAL_MODE = os.environ.get("SQLITE_JOURNAL_MODE", "WAL")
+SQLITE_SYNCHRONOUS = os.environ.get("SQLITE_SYNCHRONOUS", "NORMAL")
+SQLITE_CACHE_SIZE = int(os.environ.get("SQLITE_CACHE_SIZE", -64 * 1024))  # negative = KiB
+SQLITE_MMAP_SIZE = int(os.environ.get("SQLITE_MMAP_SIZE", 256 * 1024 * 1024))
+SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get("SQLITE_BUSY_TIMEOUT_MS", 5000))
+READ_POOL_SIZE = int(os.environ.get("DB_READ_POOL_SIZE", os.cpu_count() or 1))
+WRITE_BATCH_MAX = int(os.environ.get("DB_WRITE_BATCH_MAX", 64))
+
+IS_SQLITE = SQLALCHEMY_DATABASE_URL.startswith("sqlite")
+logger = logging.getLogger("database")
+
+
+def make_engine(**kwargs):
+    connect_args = {"check_same_thread": False} if IS_SQLITE else {}
+    new_engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args=connect_args, **kwargs)
+    if IS_SQLITE:
+        event.listen(new_engine, "connect", apply_sqlite_pragmas)
+    return new_engine
+
+
+def apply_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f"PRAGMA journal_mode = {SQLITE_JOURNAL_MODE}")
+    cursor.execute(f"PRAGMA synchronous = {SQLITE_SYNCHRONOUS}")
+    cursor.execute(f"PRAGMA cache_size = {SQLITE_CACHE_SIZE}")
+    cursor.execute(f"PRAGMA mmap_size = {SQLITE_MMAP_SIZE}")
+    cursor.execute(f"PRAGMA busy_timeout = {SQLITE_BUSY_TIMEOUT_MS}")
+    cursor.close()
+
+
+# general purpose engine, used by get_db (the sync endpoints) and for creating the schema
+engine = make_engine()
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine) # used in get_db function
 Base = declarative_base() # dziwny niby-typ, z którego dziedziczą modele tabel
+
+# read-only pool, one connection per core; query_only makes any accidental write fail loudly
+read_engine = make_engine(pool_size=READ_POOL_SIZE, max_overflow=0)
+ReadSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=read_engine)
+
+# exactly one writer connection, used only by the writer thread below
+write_engine = make_engine(pool_size=1, max_overflow=0)
+WriteSessionLocal = sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False, bind=write_engine)
+
+if IS_SQLITE:
+    @event.listens_for(read_engine, "connect")
+    def make_query_only(dbapi_connection, connection_record):
+        dbapi_connection.execute("PRAGMA query_only = ON")
+
+    # pysqlite manages transactions on its own and gets SAVEPOINTs wrong, so it's switched off and the
+    # transaction is started explicitly. IMMEDIATE takes the write lock upfront: a deferred transaction
+    # that upgrades from read to write can fail with "database is locked" without waiting for busy_timeout.
+    @event.listens_for(write_engine, "connect")
+    def disable_pysqlite_transactions(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(write_engine, "begin")
+    def begin_immediate(connection):
+        connection.exec_driver_sql("BEGIN IMMEDIATE")
+
+
+# ------------------- Blocking DB access from async endpoints ------------------- #
+# `async def` endpoints run on the event loop, so a synchronous Session used there directly
+# stalls every other request and websocket of the worker.
+# - run_read moves read-only work onto a bounded thread pool backed by the read connection pool,
+# - run_write hands writes to a single writer thread. Writes queued while the previous batch was being
+#   committed are executed together, each in its own SAVEPOINT, and committed once (group commit).
+#   Write functions must not commit themselves; work that may only happen once the data is committed
+#   (updating in-memory indexes, invalidating caches, ...) is registered with on_commit().
+DB_EXECUTOR_WORKERS = int(os.environ.get("DB_EXECUTOR_WORKERS", READ_POOL_SIZE))
+db_executor = ThreadPoolExecutor(max_workers=DB_EXECUTOR_WORKERS, thread_name_prefix="db")
+
+
+async def run_read(fn, *args):
+    """Awaits fn(db, *args) called in the DB thread pool with a fresh read-only session (closed afterwards)."""
+    def call():
+        with ReadSessionLocal() as db:
+            return fn(db, *args)
+
+    # copy the context so that context variables set by the request are visible in the worker thread
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(db_executor, context.run, call)
+
+
+def insert_returning_keys(db, table, key, rows):
+    """Bulk insert returning the new integer primary keys in the order of rows.
+    RETURNING with sort_by_parameter_order makes SQLAlchemy insert row by row on SQLite; instead the rows go
+    in a few multi-row INSERTs and the keys are sorted, SQLite allocates new rowids in ascending order."""
+    if not rows:
+        return []
+    return sorted(db.execute(insert(table).returning(key), rows).scalars().all())
+
+
+def on_commit(db, callback):
+    """Runs callback() once the write session `db` has committed (dropped if the write is rolled back)."""
+    db.info.setdefault("on_commit", []).append(callback)
+
+
+class Writer:
+    def __init__(self, batch_max=WRITE_BATCH_MAX):
+        self.batch_max = batch_max
+        self._jobs = queue.SimpleQueue()
+        self._thread = None
+        self._start_lock = threading.Lock()
+
+    def submit(self, fn, args):
+        if self._thread is None:
+            with self._start_lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+                    self._thread.start()
+        future = Future()
+        self._jobs.put((fn, args, future, contextvars.copy_context()))
+        return future
+
+    def _run(self):
+        while True:
+            batch = [self._jobs.get()]
+            while len(batch) < self.batch_max:
+                try:
+                    batch.append(self._jobs.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._write_batch(batch)
+            except Exception as e:
+                # e.g. the rollback or closing the session failed: the thread must survive it, otherwise
+                # every later run_write would wait forever
+                logger.exception("Write batch failed")
+                for _, _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+    @staticmethod
+    def _execute(db, fn, args):
+        result = fn(db, *args)
+        db.flush()
+        return result
+
+    @staticmethod
+    def _write_batch(batch):
+        done = []
+        with WriteSessionLocal() as db:
+            callbacks = db.info.setdefault("on_commit", [])
+            try:
+                for fn, args, future, context in batch:
+                    registered = len(callbacks)
+                    try:
+                        with db.begin_nested():
+                            # the flush runs in the submitter's context too, so its queries are counted
+                            # for the request that caused them
+                            result = context.run(Writer._execute, db, fn, args)
+                    except Exception as e:
+                        # only this job's savepoint is rolled back, the rest of the batch goes on
+                        del callbacks[registered:]
+                        future.set_exception(e)
+                    else:
+                        done.append((future, result))
+                db.commit()
+            except Exception as e:
+                db.rollback()
+                for future, _ in done:
+                    future.set_exception(e)
+                return
+            for callback in callbacks:
+                try:
+                    callback()
+                except Exception:
+                    logger.exception("on_commit callback failed")
+            for future, result in done:
+                future.set_result(result)
+
+
+writer = Writer()
+
+
+async def run_write(fn, *args):
+    """Awaits fn(db, *args) executed and committed by the single writer thread."""
+    return await asyncio.wrap_future(writer.submit(fn, args))
+
+
+def run_write_blocking(fn, *args):
+    """run_write for synchronous code outside the event loop (sync endpoints, ...), blocks until committed."""
+    return writer.submit(fn, args).result()
@@ -0,0 +1,221 @@
+import contextvars
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter as StatementCounter
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# ------------------------- Prometheus-format metrics ------------------------- #
+# A few dependency-free metric types rendered in the Prometheus text format on /metrics.
+# Updates only take a lock and touch a dict, so they're cheap enough for every request and query.
+# Values that are cheaper to read on demand (e.g. websocket queue depths) are registered as collectors.
+N_PLUS_ONE_THRESHOLD = int(os.environ.get("N_PLUS_ONE_THRESHOLD", 10))
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+logger = logging.getLogger("metrics")
+
+
+def _labels(names, values):
+    if not names:
+        return ""
+    pairs = (f'{name}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+             for name, value in zip(names, values))
+    return "{" + ",".join(pairs) + "}"
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        registry.append(self)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            values = list(self._values.items())
+        for label_values, value in values:
+            lines.extend(self._render_value(label_values, value))
+        return lines
+
+    def _render_value(self, label_values, value):
+        return [f"{self.name}{_labels(self.label_names, label_values)} {value}"]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def dec(self, *label_values, amount=1):
+        self.inc(*label_values, amount=-amount)
+
+    def set(self, *label_values, value):
+        with self._lock:
+            self._values[label_values] = value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, description, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, *label_values, value):
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(label_values)
+            if state is None:
+                # per bucket (non-cumulative) counts + the +Inf bucket, sum
+                state = self._values[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][i] += 1
+            state[1] += value
+
+    def _render_value(self, label_values, state):
+        counts, total = state[0][:], state[1]
+        names = self.label_names + ("le",)
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ("+Inf",), counts):
+            cumulative += count
+            lines.append(f"{self.name}_bucket{_labels(names, label_values + (bound,))} {cumulative}")
+        lines.append(f"{self.name}_sum{_labels(self.label_names, label_values)} {total}")
+        lines.append(f"{self.name}_count{_labels(self.label_names, label_values)} {cumulative}")
+        return lines
+
+
+registry = []
+collectors = []  # functions returning exposition lines, called on every scrape
+
+
+def register_collector(collect):
+    collectors.append(collect)
+
+
+def render():
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    for collect in collectors:
+        lines.extend(collect())
+    return "\n".join(lines) + "\n"
+
+
+# ------------------------------- HTTP requests ------------------------------- #
+http_requests = Counter("http_requests_total", "Finished HTTP requests", ("method", "route", "status"))
+http_latency = Histogram("http_request_duration_seconds", "HTTP request latency", ("method", "route"))
+http_in_flight = Gauge("http_requests_in_flight", "HTTP requests being handled", ("method",))
+http_db_queries = Histogram("http_request_db_queries", "DB queries per HTTP request", ("method", "route"),
+                            buckets=COUNT_BUCKETS)
+http_db_seconds = Histogram("http_request_db_seconds", "DB time per HTTP request", ("method", "route"))
+n_plus_one_warnings = Counter("n_plus_one_warnings_total",
+                              "Requests repeating one statement at least N_PLUS_ONE_THRESHOLD times", ("route",))
+db_queries = Counter("db_queries_total", "Executed DB statements (executemany counts once)")
+db_query_seconds = Histogram("db_query_duration_seconds", "DB statement latency")
+
+
+class RequestStats:
+    __slots__ = ("queries", "db_seconds", "statements")
+
+    def __init__(self):
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.statements = StatementCounter()
+
+
+# set by the middleware; run_read/run_write and the threadpool copy the context, so DB work in worker threads
+# is attributed to the right request too
+current_request = contextvars.ContextVar("current_request", default=None)
+
+
+class MetricsMiddleware:
+    """Pure ASGI middleware (no per-request Request/Response objects) recording per route template."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        method = scope["method"]
+        status = 500
+        stats = RequestStats()
+        token = current_request.set(stats)
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        http_in_flight.inc(method)
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - started
+            http_in_flight.dec(method)
+            current_request.reset(token)
+            # the router stores the matched route in the scope; the template keeps the label cardinality bounded
+            route = scope.get("route")
+            template = getattr(route, "path", None) or "unmatched"
+            http_requests.inc(method, template, status)
+            http_latency.observe(method, template, value=elapsed)
+            http_db_queries.observe(method, template, value=stats.queries)
+            http_db_seconds.observe(method, template, value=stats.db_seconds)
+            if stats.statements:
+                statement, count = stats.statements.most_common(1)[0]
+                if count >= N_PLUS_ONE_THRESHOLD:
+                    n_plus_one_warnings.inc(template)
+                    logger.warning("Possible N+1 queries in %s %s: %d executions of %s",
+                                   method, template, count, " ".join(statement.split())[:200])
+
+
+# --------------------------------- DB queries --------------------------------- #
+@event.listens_for(Engine, "before_cursor_execute")
+def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_started", []).append((cursor, time.perf_counter()))
+
+
+# after_cursor_execute doesn't fire for a failed statement, its entry is dropped here instead
+# (otherwise it would stay on the pooled connection for good)
+@event.listens_for(Engine, "handle_error")
+def drop_query_timer(exception_context):
+    context = exception_context.execution_context
+    if exception_context.connection is None or context is None:
+        return  # failed before any statement was sent
+    started = exception_context.connection.info.get("query_started")
+    if started and started[-1][0] is context.cursor:
+        started.pop()
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def record_query(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["query_started"].pop()[1]
+    db_queries.inc()
+    db_query_seconds.observe(value=elapsed)
+    stats = current_request.get()
+    if stats is not None:
+        stats.queries += 1
+        stats.db_seconds += elapsed
+        stats.statements[statement] += 1
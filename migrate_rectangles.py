@@ -0,0 +1,40 @@
+"""
+Rewrites Images.rectangles stored as JSON text (the old JsonWrapper column) into the packed binary format.
+Safe to stop and re-run: rows are converted in chunks, each committed separately, and only JSON rows are touched.
+python migrate_rectangles.py [--chunk-size 1000]
+"""
+import argparse
+import time
+from sqlalchemy import select, update, func, bindparam
+import models
+from database import engine
+
+
+def migrate_rectangles(engine, chunk_size=1000):
+    images = models.Images.__table__
+    migrated = 0
+    last_id = 0
+    while True:
+        with engine.begin() as connection:
+            rows = connection.execute(
+                select(images.c.id, images.c.rectangles)
+                .where(images.c.id > last_id, func.typeof(images.c.rectangles) == 'text')
+                .order_by(images.c.id).limit(chunk_size)).all()
+            if not rows:
+                return migrated
+            # reading through PackedRectangles decoded the JSON, writing through it packs the rectangles
+            connection.execute(
+                update(images).where(images.c.id == bindparam('image_id')).values(rectangles=bindparam('packed')),
+                [{'image_id': image_id, 'packed': rectangles} for image_id, rectangles in rows])
+        migrated += len(rows)
+        last_id = rows[-1].id
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert JSON image rectangles into the packed binary format")
+    parser.add_argument("--chunk-size", type=int, default=1000)
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    count = migrate_rectangles(engine, args.chunk_size)
+    print(f"Migrated {count} images in {time.perf_counter() - started:.2f}s")
@@ -1,8 +1,9 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, Table
+from sqlalchemy import Column, Integer, String, ForeignKey, Table, Index, DDL, event
 import sqlalchemy.types as types
 from sqlalchemy.orm import relationship
 from sqlalchemy.ext.declarative import declarative_base
 from database import Base
+from packed_rectangles import RectangleArray, pack_rectangles
 import json
 
 
@@ -28,25 +29,55 @@ class Users(Base):
 
 class Reviews(Base):
     __tablename__ = "reviews"
+    # the listings are keyset-paginated newest first or best rated first (see server.py),
+    # these indexes answer them without a sort (the foreign keys aren't enforced by SQLite by default)
+    __table_args__ = (
+        Index("ix_reviews_book_id_id", "book_id", "id"),
+        Index("ix_reviews_user_id_id", "user_id", "id"),
+        Index("ix_reviews_book_id_rating_id", "book_id", "rating", "id"),
+        Index("ix_reviews_user_id_rating_id", "user_id", "rating", "id"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
-    book_id = Column(Integer)
-    user_id = Column(Integer)
+    book_id = Column(Integer, ForeignKey("books.id"))
+    user_id = Column(Integer, ForeignKey("users.id"))
     review = Column(String)
     rating = Column(Integer)
 
 
+# per-book running aggregates of Reviews.rating, maintained together with inserts into reviews
+# (see ratings.py), so average/min/max reads don't have to touch the reviews table
+class BookRatingStats(Base):
+    __tablename__ = "book_rating_stats"
+
+    book_id = Column(Integer, primary_key=True)
+    review_count = Column(Integer, nullable=False)
+    rating_sum = Column(Integer, nullable=False)
+    rating_min = Column(Integer, nullable=False)
+    rating_max = Column(Integer, nullable=False)
+
+
+# rating histogram, one row per (book, bucket of RATING_BUCKET_SIZE rating points)
+class BookRatingBuckets(Base):
+    __tablename__ = "book_rating_buckets"
+
+    book_id = Column(Integer, primary_key=True)
+    bucket = Column(Integer, primary_key=True)
+    review_count = Column(Integer, nullable=False)
+
+
 class Tags(Base):
     __tablename__ = "tags"
     id = Column(Integer, primary_key=True, index=True)
-    tag = Column(String)
+    tag = Column(String, index=True)
 
 
 image_tag_table = Table(
     "link_tags",
     Base.metadata,
     Column("image_id", Integer, ForeignKey("images.id")),
-    Column("tag_id", Integer, ForeignKey("tags.id"))
+    Column("tag_id", Integer, ForeignKey("tags.id")),
+    Index("ix_link_tags_tag_id_image_id", "tag_id", "image_id"),
 )
 
 
@@ -60,6 +91,34 @@ class JsonWrapper(types.TypeDecorator):
     def process_result_value(self, value, dialect):
         return json.loads(value)
 
+class RawBlob(types.LargeBinary):
+    # no result conversion: rows written by JsonWrapper come back as str and must reach PackedRectangles untouched
+    def result_processor(self, dialect, coltype):
+        return None
+
+
+class PackedRectangles(types.TypeDecorator):
+    """Rectangles as a packed binary array (see packed_rectangles.py), read as a lazily decoded RectangleArray.
+
+    Rows still holding JSON text from JsonWrapper are decoded transparently,
+    migrate_rectangles.py rewrites them into the packed format.
+    """
+    impl = RawBlob
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        return pack_rectangles(value)
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        if isinstance(value, str):
+            return RectangleArray.from_list(json.loads(value))
+        return RectangleArray(bytes(value))
+
+
 class Images(Base):
     __tablename__ = "images"
 
@@ -67,5 +126,53 @@ class Images(Base):
     title = Column(String)
     user_id = Column(Integer)
     description = Column(String)
-    rectangles = Column(JsonWrapper)
+    rectangles = Column(PackedRectangles)
     tags = relationship(Tags, secondary=image_tag_table)
+
+
+# append-only log of image inserts/updates/deletes for incremental sync (see change_log.py);
+# AUTOINCREMENT so that sequence numbers are never reused
+class ImageChanges(Base):
+    __tablename__ = "image_changes"
+    __table_args__ = {"sqlite_autoincrement": True}
+
+    seq = Column(Integer, primary_key=True)
+    image_id = Column(Integer, nullable=False)
+    op = Column(String, nullable=False)  # insert / update / delete
+
+
+# R-tree with one entry per image rectangle, maintained by spatial.py (virtual tables can't be declared as models)
+event.listen(Base.metadata, "after_create", DDL(
+    "CREATE VIRTUAL TABLE IF NOT EXISTS image_rectangles_rtree USING rtree_i32(id, min_x, max_x, min_y, max_y)"))
+
+
+def full_text_ddl(table, columns):
+    """FTS5 index `<table>_fts` over the given text columns plus the triggers keeping it in sync.
+    External content: the index stores no copy of the text, snippets are read from `table` itself."""
+    fts = f"{table}_fts"
+    names = ", ".join(columns)
+    new = ", ".join(f"new.{column}" for column in columns)
+    old = ", ".join(f"old.{column}" for column in columns)
+    insert_new = f"INSERT INTO {fts} (rowid, {names}) VALUES (new.id, {new});"
+    delete_old = f"INSERT INTO {fts} ({fts}, rowid, {names}) VALUES ('delete', old.id, {old});"
+    return [
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5({names}, content='{table}', content_rowid='id', "
+        f"tokenize='porter unicode61 remove_diacritics 2')",
+        f"CREATE TRIGGER IF NOT EXISTS {fts}_insert AFTER INSERT ON {table} BEGIN {insert_new} END",
+        f"CREATE TRIGGER IF NOT EXISTS {fts}_delete AFTER DELETE ON {table} BEGIN {delete_old} END",
+        f"CREATE TRIGGER IF NOT EXISTS {fts}_update AFTER UPDATE OF {names} ON {table} "
+        f"BEGIN {delete_old} {insert_new} END",
+    ]
+
+
+# full-text search over books and reviews, queried by search.py
+for statement in full_text_ddl("books", ["title", "author", "description"]) + full_text_ddl("reviews", ["review"]):
+    event.listen(Base.metadata, "after_create", DDL(statement))
+
+
+def ensure_indexes(engine):
+    # create_all() only creates indexes together with their tables,
+    # so indexes added to already existing tables have to be created separately
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=engine, checkfirst=True)
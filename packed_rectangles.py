@@ -0,0 +1,105 @@
+import struct
+import numpy as np
+
+# ------------------- Packed binary encoding of image rectangles ------------------- #
+# Layout (little endian):
+#   b"RECT", version (u8)
+#   number of colors (u16), then every color as: byte length (u16) + utf-8 bytes
+#   number of rectangles (u32), then fixed-width records of RECORD_DTYPE
+# Colors are stored once per image in the dictionary, records only keep an index into it.
+MAGIC = b"RECT"
+VERSION = 1
+RECORD_DTYPE = np.dtype([('x', '<i4'), ('y', '<i4'), ('width', '<i4'), ('height', '<i4'), ('color', '<u2')])
+FIELDS = ('x', 'y', 'width', 'height')
+# what fits into the format, the API rejects anything larger
+MAX_COORDINATE = np.iinfo(np.int32).max
+MAX_COLORS = 0xFFFF
+MAX_COLOR_LENGTH = 0xFFFF // 4  # characters; the length is stored in bytes and utf-8 takes up to 4 per character
+
+_header = struct.Struct('<4sB')
+_u16 = struct.Struct('<H')
+_u32 = struct.Struct('<I')
+
+
+def pack_rectangles(rectangles):
+    """Encodes a list of rectangle dicts ({x, y, width, height, color}) into the packed format."""
+    if isinstance(rectangles, RectangleArray):
+        return rectangles.to_bytes()
+    color_index = {}
+    records = np.empty(len(rectangles), dtype=RECORD_DTYPE)
+    for i, rectangle in enumerate(rectangles):
+        color = color_index.setdefault(rectangle['color'], len(color_index))
+        records[i] = (rectangle['x'], rectangle['y'], rectangle['width'], rectangle['height'], color)
+
+    parts = [_header.pack(MAGIC, VERSION), _u16.pack(len(color_index))]
+    for color in color_index:
+        encoded = color.encode('utf-8')
+        parts.append(_u16.pack(len(encoded)))
+        parts.append(encoded)
+    parts.append(_u32.pack(len(records)))
+    parts.append(records.tobytes())
+    return b''.join(parts)
+
+
+class RectangleArray:
+    """Rectangles of one image backed by the packed bytes; decoded lazily into NumPy arrays on first access."""
+    __slots__ = ('_blob', '_colors', '_records')
+
+    def __init__(self, blob):
+        self._blob = blob
+        self._colors = None
+        self._records = None
+
+    @classmethod
+    def from_list(cls, rectangles):
+        return cls(pack_rectangles(rectangles))
+
+    def _decode(self):
+        magic, version = _header.unpack_from(self._blob, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"Not a packed rectangle array (magic={magic!r}, version={version})")
+        offset = _header.size
+        (color_count,) = _u16.unpack_from(self._blob, offset)
+        offset += _u16.size
+        colors = []
+        for _ in range(color_count):
+            (length,) = _u16.unpack_from(self._blob, offset)
+            offset += _u16.size
+            colors.append(self._blob[offset:offset + length].decode('utf-8'))
+            offset += length
+        (count,) = _u32.unpack_from(self._blob, offset)
+        offset += _u32.size
+        # zero-copy view into the blob
+        self._records = np.frombuffer(self._blob, dtype=RECORD_DTYPE, count=count, offset=offset)
+        self._colors = colors
+
+    @property
+    def records(self):
+        """Structured array with fields x, y, width, height and color (index into colors)."""
+        if self._records is None:
+            self._decode()
+        return self._records
+
+    @property
+    def colors(self):
+        if self._colors is None:
+            self._decode()
+        return self._colors
+
+    def __len__(self):
+        return len(self.records)
+
+    def __iter__(self):
+        return iter(self.tolist())
+
+    def to_bytes(self):
+        return self._blob
+
+    def tolist(self):
+        """The API shape: [{x, y, width, height, color}, ...]."""
+        colors = self.colors
+        return [{'x': x, 'y': y, 'width': width, 'height': height, 'color': colors[color]}
+                for x, y, width, height, color in self.records.tolist()]
+
+    def __repr__(self):
+        return f"RectangleArray({self.tolist()!r})"
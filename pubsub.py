@@ -0,0 +1,210 @@
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+import metrics
+
+# ------------------------ pub/sub between server processes ------------------------ #
+# With `uvicorn --workers N` every process has its own ConnectionManager, so a broadcast only reaches
+# the clients connected to the same process. A broker forwards broadcasts to the other processes:
+# the publishing process delivers to its own clients directly, every other process gets the message
+# from the broker and delivers it to its clients (messages carry the origin, so nothing arrives twice).
+# PUBSUB_URL selects the backend:
+#   local (default)          - a single process, nothing to forward
+#   sqlite:///./pubsub.db    - processes on one machine share a small SQLite log, polled every PUBSUB_POLL_INTERVAL
+#   redis://host:6379/0      - Redis PUBLISH/PSUBSCRIBE (needs the `redis` package), also across machines
+PUBSUB_URL = os.environ.get("PUBSUB_URL", "local")
+PUBSUB_POLL_INTERVAL = float(os.environ.get("PUBSUB_POLL_INTERVAL", 0.02))
+PUBSUB_RETENTION_SECONDS = float(os.environ.get("PUBSUB_RETENTION_SECONDS", 60))
+PUBSUB_CHANNEL_PREFIX = os.environ.get("PUBSUB_CHANNEL_PREFIX", "ws:")
+FETCH_BATCH_SIZE = 1000
+
+logger = logging.getLogger("pubsub")
+published = metrics.Counter("pubsub_published_total", "Messages published to other processes", ("channel",))
+received = metrics.Counter("pubsub_received_total", "Messages received from other processes", ("channel",))
+
+
+class Broker:
+    """In-process broker, also the interface of the others: subscribe() callbacks are called with the
+    messages other processes publish on the channel (never with the process' own messages)."""
+
+    def __init__(self):
+        self.origin = uuid.uuid4().hex
+        self._subscribers = {}  # channel -> [callback(message)]
+
+    def subscribe(self, channel, callback):
+        self._subscribers.setdefault(channel, []).append(callback)
+
+    def _dispatch(self, channel, message):
+        received.inc(channel)
+        for callback in self._subscribers.get(channel, ()):
+            try:
+                callback(message)
+            except Exception:
+                logger.exception("Subscriber of %s failed", channel)
+
+    async def start(self):
+        pass
+
+    async def publish(self, channel, message):
+        pass
+
+    async def close(self):
+        pass
+
+
+class SqliteBroker(Broker):
+    """Append-only message log in a SQLite file shared by the processes of one machine.
+    publish() only queues the message, a background task inserts everything queued in one transaction;
+    another task polls for rows of other processes. Rows older than the retention are deleted."""
+
+    def __init__(self, path, poll_interval=PUBSUB_POLL_INTERVAL, retention=PUBSUB_RETENTION_SECONDS):
+        super().__init__()
+        self.path = path
+        self.poll_interval = poll_interval
+        self.retention = retention
+        self._outbox = asyncio.Queue()
+        self._tasks = []
+        self._last_id = 0
+        self._pruned_at = 0.0
+        # a cancelled to_thread call keeps running, so the connections are only used under this lock
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        connection.execute("PRAGMA journal_mode = WAL")
+        connection.execute("PRAGMA synchronous = OFF")  # messages are ephemeral
+        connection.execute("PRAGMA busy_timeout = 5000")
+        return connection
+
+    async def start(self):
+        self._writer = self._connect()
+        self._reader = self._connect()
+        # AUTOINCREMENT: ids are never reused after pruning, so `id > last seen` can't miss messages
+        self._writer.execute("CREATE TABLE IF NOT EXISTS pubsub_messages (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                             "channel TEXT NOT NULL, origin TEXT NOT NULL, message TEXT NOT NULL, "
+                             "created_at REAL NOT NULL)")
+        self._last_id = self._reader.execute("SELECT coalesce(max(id), 0) FROM pubsub_messages").fetchone()[0]
+        self._tasks = [asyncio.create_task(self._flush()), asyncio.create_task(self._poll())]
+
+    async def publish(self, channel, message):
+        self._outbox.put_nowait((channel, message))
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        # whatever is still queued goes out before the process exits
+        batch = []
+        while not self._outbox.empty():
+            batch.append(self._outbox.get_nowait())
+        if batch:
+            self._insert(batch)
+        with self._lock:
+            self._writer.close()
+            self._reader.close()
+
+    async def _flush(self):
+        while True:
+            batch = [await self._outbox.get()]
+            while not self._outbox.empty():
+                batch.append(self._outbox.get_nowait())
+            try:
+                await asyncio.to_thread(self._insert, batch)
+            except Exception:
+                logger.exception("Publishing %d messages failed", len(batch))
+
+    def _insert(self, batch):
+        with self._lock:
+            self._insert_locked(batch)
+        for channel, _ in batch:
+            published.inc(channel)
+
+    def _insert_locked(self, batch):
+        now = time.time()
+        self._writer.execute("BEGIN IMMEDIATE")
+        try:
+            self._writer.executemany("INSERT INTO pubsub_messages (channel, origin, message, created_at) "
+                                     "VALUES (?, ?, ?, ?)",
+                                     [(channel, self.origin, message, now) for channel, message in batch])
+            if now - self._pruned_at > self.retention / 2:
+                self._writer.execute("DELETE FROM pubsub_messages WHERE created_at < ?", (now - self.retention,))
+                self._pruned_at = now
+            self._writer.execute("COMMIT")
+        except Exception:
+            self._writer.execute("ROLLBACK")
+            raise
+
+    async def _poll(self):
+        while True:
+            try:
+                rows = await asyncio.to_thread(self._fetch)
+            except Exception:
+                logger.exception("Polling %s failed", self.path)
+                rows = []
+            for channel, message in rows:
+                self._dispatch(channel, message)
+            if len(rows) < FETCH_BATCH_SIZE:
+                await asyncio.sleep(self.poll_interval)
+
+    def _fetch(self):
+        with self._lock:
+            rows = self._reader.execute("SELECT id, channel, origin, message FROM pubsub_messages WHERE id > ? "
+                                        "ORDER BY id LIMIT ?", (self._last_id, FETCH_BATCH_SIZE)).fetchall()
+        if rows:
+            self._last_id = rows[-1][0]
+        return [(channel, message) for _, channel, origin, message in rows if origin != self.origin]
+
+
+class RedisBroker(Broker):
+    """Redis (or any server speaking its protocol, e.g. Valkey, KeyDB) PUBLISH / PSUBSCRIBE."""
+
+    def __init__(self, url, prefix=PUBSUB_CHANNEL_PREFIX):
+        super().__init__()
+        # optional dependency, only needed for this backend
+        import redis.asyncio
+        self._redis = redis.asyncio.from_url(url)
+        self.prefix = prefix
+        self._pubsub = None
+        self._task = None
+
+    async def start(self):
+        self._pubsub = self._redis.pubsub(ignore_subscribe_messages=True)
+        await self._pubsub.psubscribe(self.prefix + "*")
+        self._task = asyncio.create_task(self._listen())
+
+    async def publish(self, channel, message):
+        await self._redis.publish(self.prefix + channel, json.dumps({"origin": self.origin, "message": message}))
+        published.inc(channel)
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        if self._pubsub is not None:
+            await self._pubsub.aclose()
+        await self._redis.aclose()
+
+    async def _listen(self):
+        async for item in self._pubsub.listen():
+            if item["type"] != "pmessage":
+                continue
+            envelope = json.loads(item["data"])
+            if envelope["origin"] != self.origin:
+                channel = item["channel"].decode()[len(self.prefix):]
+                self._dispatch(channel, envelope["message"])
+
+
+def make_broker(url=PUBSUB_URL):
+    if url in ("", "local"):
+        return Broker()
+    if url.startswith("sqlite:///"):
+        return SqliteBroker(url[len("sqlite:///"):])
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisBroker(url)
+    raise ValueError(f"Unsupported PUBSUB_URL {url!r}")
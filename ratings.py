@@ -0,0 +1,101 @@
+from sqlalchemy import func, delete, insert, select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+import models
+
+# ------------------ Incrementally maintained rating aggregates ------------------ #
+# Every insert into `reviews` has to go through record_ratings() in the same transaction,
+# so that book_rating_stats/book_rating_buckets always match the reviews table.
+RATING_BUCKET_SIZE = 10
+RATING_BUCKETS = 100 // RATING_BUCKET_SIZE + 1  # ratings are 0..100 (see the Review api model)
+
+stats_table = models.BookRatingStats.__table__
+buckets_table = models.BookRatingBuckets.__table__
+
+
+def record_ratings(db, book_id, ratings):
+    """Adds the given ratings of a single book to its aggregates (atomic upserts, no read needed)."""
+    record_ratings_by_book(db, {book_id: ratings})
+
+
+def record_ratings_by_book(db, ratings_by_book):
+    """record_ratings for many books at once: {book_id: [rating, ...]}, two executemany upserts in total."""
+    stats, buckets = [], []
+    for book_id, ratings in ratings_by_book.items():
+        if not ratings:
+            continue
+        stats.append({'book_id': book_id, 'review_count': len(ratings), 'rating_sum': sum(ratings),
+                      'rating_min': min(ratings), 'rating_max': max(ratings)})
+        histogram = {}
+        for rating in ratings:
+            bucket = rating // RATING_BUCKET_SIZE
+            histogram[bucket] = histogram.get(bucket, 0) + 1
+        buckets.extend({'book_id': book_id, 'bucket': bucket, 'review_count': count}
+                       for bucket, count in histogram.items())
+    if not stats:
+        return
+
+    stmt = sqlite_insert(stats_table)
+    db.execute(stmt.on_conflict_do_update(index_elements=[stats_table.c.book_id], set_={
+        'review_count': stats_table.c.review_count + stmt.excluded.review_count,
+        'rating_sum': stats_table.c.rating_sum + stmt.excluded.rating_sum,
+        # two-argument min/max are scalar functions in SQLite
+        'rating_min': func.min(stats_table.c.rating_min, stmt.excluded.rating_min),
+        'rating_max': func.max(stats_table.c.rating_max, stmt.excluded.rating_max),
+    }), stats)
+
+    stmt = sqlite_insert(buckets_table)
+    db.execute(stmt.on_conflict_do_update(
+        index_elements=[buckets_table.c.book_id, buckets_table.c.bucket],
+        set_={'review_count': buckets_table.c.review_count + stmt.excluded.review_count}), buckets)
+
+
+def rebuild_rating_stats(db):
+    """Recomputes all aggregates from scratch with two GROUP BY queries (does not commit)."""
+    reviews = models.Reviews.__table__
+    db.execute(delete(stats_table))
+    db.execute(delete(buckets_table))
+    db.execute(insert(stats_table).from_select(
+        ['book_id', 'review_count', 'rating_sum', 'rating_min', 'rating_max'],
+        select(reviews.c.book_id, func.count(), func.sum(reviews.c.rating),
+               func.min(reviews.c.rating), func.max(reviews.c.rating)).group_by(reviews.c.book_id)))
+    bucket = reviews.c.rating // RATING_BUCKET_SIZE
+    db.execute(insert(buckets_table).from_select(
+        ['book_id', 'bucket', 'review_count'],
+        select(reviews.c.book_id, bucket, func.count()).group_by(reviews.c.book_id, bucket)))
+
+
+def ensure_rating_stats(db):
+    # databases created before the aggregate tables existed have reviews but no stats yet
+    has_stats = db.execute(select(stats_table.c.book_id).limit(1)).first() is not None
+    has_reviews = db.execute(select(models.Reviews.id).limit(1)).first() is not None
+    if has_reviews and not has_stats:
+        rebuild_rating_stats(db)
+        db.commit()
+
+
+def average_rating(stats):
+    if stats is None or stats.review_count == 0:
+        return 0
+    return stats.rating_sum / stats.review_count
+
+
+def rating_summaries(db, book_ids):
+    """Aggregates for many books in two queries; books without reviews get an empty summary."""
+    stats_by_book = {stats.book_id: stats for stats in
+                     db.query(models.BookRatingStats).filter(models.BookRatingStats.book_id.in_(book_ids))}
+    histograms = {book_id: [0] * RATING_BUCKETS for book_id in book_ids}
+    for row in db.query(models.BookRatingBuckets).filter(models.BookRatingBuckets.book_id.in_(book_ids)):
+        histograms[row.book_id][row.bucket] = row.review_count
+
+    summaries = []
+    for book_id in book_ids:
+        stats = stats_by_book.get(book_id)
+        summaries.append({
+            "book_id": book_id,
+            "count": stats.review_count if stats else 0,
+            "average_rating": average_rating(stats),
+            "min_rating": stats.rating_min if stats else None,
+            "max_rating": stats.rating_max if stats else None,
+            "histogram": histograms[book_id],
+        })
+    return summaries
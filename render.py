@@ -0,0 +1,240 @@
+import os
+import shutil
+import struct
+import threading
+import time
+import zlib
+from collections import OrderedDict
+import numpy as np
+from packed_rectangles import RectangleArray
+
+# ------------------------- Raster rendering of images ------------------------- #
+# An image is drawn on a white canvas covering [0, max(x + width)) x [0, max(y + height)), scaled to the
+# requested size, rectangles painted in their order (later ones on top). Every rectangle is one NumPy slice
+# assignment. PNG and BMP are encoded here (zlib + struct), no imaging library needed.
+# This module must stay importable on its own: the thumbnail process pool workers import only this file.
+MAX_RENDER_SIZE = 2048
+BACKGROUND = (255, 255, 255)
+UNKNOWN_COLOR = (128, 128, 128)
+FORMATS = {"png": "image/png", "bmp": "image/bmp"}
+PNG_COMPRESSION = int(os.environ.get("RENDER_PNG_COMPRESSION", 6))
+
+NAMED_COLORS = {
+    'white': (255, 255, 255), 'black': (0, 0, 0), 'red': (255, 0, 0), 'green': (0, 128, 0), 'lime': (0, 255, 0),
+    'blue': (0, 0, 255), 'yellow': (255, 255, 0), 'orange': (255, 165, 0), 'purple': (128, 0, 128),
+    'pink': (255, 192, 203), 'brown': (165, 42, 42), 'gray': (128, 128, 128), 'grey': (128, 128, 128),
+    'cyan': (0, 255, 255), 'magenta': (255, 0, 255), 'navy': (0, 0, 128), 'teal': (0, 128, 128),
+    'olive': (128, 128, 0), 'maroon': (128, 0, 0), 'silver': (192, 192, 192),
+}
+
+
+def parse_color(color):
+    color = color.strip().lower()
+    if color in NAMED_COLORS:
+        return NAMED_COLORS[color]
+    if color.startswith('#') and len(color) in (4, 7):
+        digits = color[1:] if len(color) == 7 else ''.join(c * 2 for c in color[1:])
+        try:
+            return tuple(bytes.fromhex(digits))
+        except ValueError:
+            pass
+    return UNKNOWN_COLOR
+
+
+def canvas_size(records, width=None, height=None):
+    """Output size: the drawing's own extent by default, one given side keeps the aspect ratio."""
+    extent_x = max(int((records['x'] + records['width']).max()), 1) if len(records) else 1
+    extent_y = max(int((records['y'] + records['height']).max()), 1) if len(records) else 1
+    if width is None and height is None:
+        scale = min(1.0, MAX_RENDER_SIZE / max(extent_x, extent_y))
+        width, height = round(extent_x * scale), round(extent_y * scale)
+    elif width is None:
+        width = round(extent_x * height / extent_y)
+    elif height is None:
+        height = round(extent_y * width / extent_x)
+    return (min(max(width, 1), MAX_RENDER_SIZE), min(max(height, 1), MAX_RENDER_SIZE)), (extent_x, extent_y)
+
+
+def rasterize(rectangles, width=None, height=None):
+    """RectangleArray -> uint8 array of shape (height, width, 3)."""
+    records = rectangles.records
+    (width, height), (extent_x, extent_y) = canvas_size(records, width, height)
+    canvas = np.empty((height, width, 3), dtype=np.uint8)
+    canvas[:] = BACKGROUND
+    if not len(records):
+        return canvas
+    # all coordinates scaled at once; every rectangle keeps at least one pixel
+    sx, sy = width / extent_x, height / extent_y
+    x0 = np.floor(records['x'] * sx).astype(np.int64)
+    y0 = np.floor(records['y'] * sy).astype(np.int64)
+    x1 = np.maximum(np.ceil((records['x'] + records['width']) * sx).astype(np.int64), x0 + 1)
+    y1 = np.maximum(np.ceil((records['y'] + records['height']) * sy).astype(np.int64), y0 + 1)
+    palette = np.array([parse_color(color) for color in rectangles.colors], dtype=np.uint8).reshape(-1, 3)
+    fills = palette[records['color']]
+    for left, top, right, bottom, fill in zip(x0.tolist(), y0.tolist(), x1.tolist(), y1.tolist(), fills):
+        canvas[top:bottom, left:right] = fill
+    return canvas
+
+
+def _png_chunk(kind, data):
+    return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+
+def encode_png(canvas):
+    height, width, _ = canvas.shape
+    # every scanline starts with its filter type byte (0 = none)
+    scanlines = np.zeros((height, width * 3 + 1), dtype=np.uint8)
+    scanlines[:, 1:] = canvas.reshape(height, width * 3)
+    return b''.join([
+        b'\x89PNG\r\n\x1a\n',
+        _png_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)),  # 8 bit RGB
+        _png_chunk(b'IDAT', zlib.compress(scanlines.tobytes(), PNG_COMPRESSION)),
+        _png_chunk(b'IEND', b''),
+    ])
+
+
+def encode_bmp(canvas):
+    height, width, _ = canvas.shape
+    row_size = (width * 3 + 3) & ~3  # rows are padded to 4 bytes
+    rows = np.zeros((height, row_size), dtype=np.uint8)
+    rows[:, :width * 3] = canvas[::-1, :, ::-1].reshape(height, width * 3)  # bottom-up, BGR
+    pixels = rows.tobytes()
+    header = struct.pack('<2sIHHI', b'BM', 54 + len(pixels), 0, 0, 54)
+    info = struct.pack('<IiiHHIIiiII', 40, width, height, 1, 24, 0, len(pixels), 2835, 2835, 0, 0)
+    return header + info + pixels
+
+
+ENCODERS = {"png": encode_png, "bmp": encode_bmp}
+
+
+def render(rectangles, width=None, height=None, image_format="png"):
+    return ENCODERS[image_format](rasterize(rectangles, width, height))
+
+
+def render_blobs(jobs):
+    """Process pool entry point: [(key, packed rectangle bytes, width, height, format)] -> [(key, encoded)].
+    Takes the packed bytes, which pickle cheaply, instead of RectangleArray objects."""
+    return [(key, render(RectangleArray(blob), width, height, image_format))
+            for key, blob, width, height, image_format in jobs]
+
+
+# ------------------------- Cache of rendered images ------------------------- #
+# Size-bounded (in bytes) LRU in memory. With a directory it's also written to disk, where renders
+# survive restarts and are shared by the worker processes; memory then works as the hot front.
+# invalidate(image_id) is called after the commit of every update/delete of the image; like in
+# response_cache.py a render computed concurrently with it isn't stored (generation check in put()).
+# Other worker processes only see the invalidation through the disk (the image's directory is removed), so the
+# memory entries expire after a TTL and are then re-read from the disk, if there is one, or rendered again.
+# The generation check can't see the other processes either: one of them may write back a render of the old
+# data just after the directory was removed. So the files expire after the same TTL (by their mtime) and a memory
+# entry read from a file expires with it, a stale render is never served longer than RENDER_CACHE_TTL.
+RENDER_CACHE_BYTES = int(os.environ.get("RENDER_CACHE_BYTES", 64 * 1024 * 1024))
+RENDER_CACHE_TTL = float(os.environ.get("RENDER_CACHE_TTL", 60))
+RENDER_CACHE_DIR = os.environ.get("RENDER_CACHE_DIR") or None
+
+
+class RenderCache:
+    def __init__(self, max_bytes=RENDER_CACHE_BYTES, directory=RENDER_CACHE_DIR, ttl=RENDER_CACHE_TTL):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.ttl = ttl
+        # (image_id, width, height, format) -> (bytes, expires_at), least recently used first
+        self._entries = OrderedDict()
+        self._keys_by_image = {}
+        self._size = 0
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def generation(self):
+        return self._generation
+
+    def _path(self, key):
+        image_id, width, height, image_format = key
+        return os.path.join(self.directory, str(image_id), f"{width or 'auto'}x{height or 'auto'}.{image_format}")
+
+    def get(self, key):
+        """The render from memory only, never blocks on the disk (see read())."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            data, expires_at = entry
+            if expires_at >= time.monotonic():
+                self._entries.move_to_end(key)
+                return data
+            self._remove(key)
+            return None
+
+    def read(self, keys):
+        """{key: render} of the keys found on the disk (and not expired), kept in memory from then on.
+        Blocking file I/O, async code calls it in a thread."""
+        found = {}
+        if self.directory is None:
+            return found
+        for key in keys:
+            try:
+                with open(self._path(key), 'rb') as file:
+                    remaining = os.fstat(file.fileno()).st_mtime + self.ttl - time.time()
+                    if remaining < 0:
+                        continue
+                    data = file.read()
+            except OSError:
+                continue
+            self._store(key, data, expires_at=time.monotonic() + remaining)
+            found[key] = data
+        return found
+
+    def put(self, key, data, generation):
+        """Blocking file I/O with a directory, like read()."""
+        with self._lock:
+            if generation != self._generation:
+                return
+        if self.directory is not None:
+            path = self._path(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # written under a temporary name and renamed, readers never see half a file
+            temporary = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(temporary, 'wb') as file:
+                file.write(data)
+            os.replace(temporary, path)
+        self._store(key, data, generation)
+
+    def _store(self, key, data, generation=None, expires_at=None):
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return
+            if len(data) > self.max_bytes:
+                return
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (data, time.monotonic() + self.ttl if expires_at is None else expires_at)
+            self._keys_by_image.setdefault(key[0], set()).add(key)
+            self._size += len(data)
+            while self._size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, key):
+        data, _ = self._entries.pop(key)
+        self._size -= len(data)
+        keys = self._keys_by_image.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._keys_by_image[key[0]]
+
+    def invalidate(self, image_id):
+        with self._lock:
+            self._generation += 1
+            for key in list(self._keys_by_image.get(image_id, ())):
+                self._remove(key)
+        if self.directory is not None:
+            shutil.rmtree(os.path.join(self.directory, str(image_id)), ignore_errors=True)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+            self._keys_by_image.clear()
+            self._size = 0
+        if self.directory is not None:
+            shutil.rmtree(self.directory, ignore_errors=True)
@@ -0,0 +1,112 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from fastapi import Response
+
+# ---------------------- In-process cache of serialized responses ---------------------- #
+# Entries are keyed by route + parameters and tagged with the data they were built from
+# (e.g. ("image", 5), "images", "tags"). Writers call invalidate() with the same dependencies
+# right AFTER their commit; a response computed concurrently with a write is then simply not stored
+# (see the generation check in put()), so the cache never serves data older than the last commit.
+# Entries also expire after a TTL, which bounds staleness caused by writes of other worker processes.
+# Bounded by the number of entries and by the total size of the bodies; bodies larger than
+# RESPONSE_CACHE_MAX_BODY (e.g. an unpaginated listing) are served but not stored.
+RESPONSE_CACHE_SIZE = int(os.environ.get("RESPONSE_CACHE_SIZE", 1024))
+RESPONSE_CACHE_BYTES = int(os.environ.get("RESPONSE_CACHE_BYTES", 64 * 1024 * 1024))
+RESPONSE_CACHE_MAX_BODY = int(os.environ.get("RESPONSE_CACHE_MAX_BODY", 1024 * 1024))
+RESPONSE_CACHE_TTL = float(os.environ.get("RESPONSE_CACHE_TTL", 60))
+
+
+class CachedResponse:
+    __slots__ = ("body", "etag", "headers", "expires_at", "dependencies")
+
+    def __init__(self, body, headers, expires_at, dependencies):
+        self.body = body
+        self.etag = '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+        self.headers = headers
+        self.expires_at = expires_at
+        self.dependencies = dependencies
+
+    def matches(self, if_none_match):
+        if not if_none_match:
+            return False
+        tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+        return "*" in tags or self.etag in tags
+
+    def to_response(self, request, media_type="application/json"):
+        headers = {"ETag": self.etag, "Cache-Control": "no-cache", **self.headers}
+        if self.matches(request.headers.get("if-none-match")):
+            return Response(status_code=304, headers=headers)
+        return Response(content=self.body, media_type=media_type, headers=headers)
+
+
+class ResponseCache:
+    def __init__(self, max_entries=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL, max_bytes=RESPONSE_CACHE_BYTES,
+                 max_body=RESPONSE_CACHE_MAX_BODY):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.max_body = min(max_body, max_bytes)
+        self._entries = OrderedDict()  # key -> CachedResponse, least recently used first
+        self._size = 0  # bytes of all bodies
+        self._keys_by_dependency = {}
+        self._generation = 0
+        # invalidate() is called from the DB worker threads
+        self._lock = threading.Lock()
+
+    def generation(self):
+        return self._generation
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry.expires_at < time.monotonic():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key, body, headers, dependencies, generation):
+        """Stores the entry unless something was invalidated since `generation` was read; returns it either way."""
+        entry = CachedResponse(body, headers, time.monotonic() + self.ttl, tuple(dependencies))
+        with self._lock:
+            if generation != self._generation or len(body) > self.max_body:
+                return entry
+            self._remove(key)
+            self._entries[key] = entry
+            self._size += len(body)
+            for dependency in entry.dependencies:
+                self._keys_by_dependency.setdefault(dependency, set()).add(key)
+            while len(self._entries) > self.max_entries or self._size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+        return entry
+
+    def invalidate(self, *dependencies):
+        with self._lock:
+            self._generation += 1
+            for dependency in dependencies:
+                for key in self._keys_by_dependency.pop(dependency, ()):
+                    self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+            self._keys_by_dependency.clear()
+            self._size = 0
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        self._size -= len(entry.body)
+        for dependency in entry.dependencies:
+            keys = self._keys_by_dependency.get(dependency)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._keys_by_dependency[dependency]
@@ -0,0 +1,69 @@
+import re
+from sqlalchemy import text
+
+# ------------------------- Full-text search over books and reviews ------------------------- #
+# books_fts and reviews_fts are FTS5 indexes (created in models.py) over the text columns of books and reviews.
+# Triggers on the base tables keep them in sync with every insert, update and delete, whichever code path
+# writes the rows (the endpoints, seed.py, ...).
+# Results are ranked with bm25, a match in a book title counts more than one in its description.
+# Pagination is limit/offset: the relevance order has no stable key to continue after.
+BOOK_WEIGHTS = "10.0, 5.0, 1.0"  # title, author, description
+SNIPPET_TOKENS = 12
+HIGHLIGHT_OPEN, HIGHLIGHT_CLOSE, ELLIPSIS = "<b>", "</b>", "…"
+
+_word = re.compile(r"\w+\*?")
+
+
+def fts_query(query):
+    """User input -> FTS5 query where every word has to match (`word*` = prefix match).
+    Quotes and operators in the input have no special meaning, so it can't be a syntax error."""
+    terms = []
+    for word in _word.findall(query):
+        prefix = word.endswith("*")
+        terms.append(f'"{word.rstrip("*")}"' + ("*" if prefix else ""))
+    return " ".join(terms)
+
+
+def _search(db, sql, query, limit, offset, **params):
+    match = fts_query(query)
+    if not match:
+        return []
+    rows = db.execute(text(sql), {"query": match, "limit": limit, "offset": offset, "open": HIGHLIGHT_OPEN,
+                                  "close": HIGHLIGHT_CLOSE, "ellipsis": ELLIPSIS, "tokens": SNIPPET_TOKENS, **params})
+    # bm25 is lower for better matches, the API returns a score where higher is better
+    return [dict(row, score=-row["score"]) for row in rows.mappings()]
+
+
+def search_books(db, query, limit, offset):
+    return _search(db, f"""
+        SELECT books.id, books.title, books.author, books.rating,
+               bm25(books_fts, {BOOK_WEIGHTS}) AS score,
+               highlight(books_fts, 0, :open, :close) AS title_highlighted,
+               snippet(books_fts, -1, :open, :close, :ellipsis, :tokens) AS snippet
+        FROM books_fts JOIN books ON books.id = books_fts.rowid
+        WHERE books_fts MATCH :query
+        ORDER BY score LIMIT :limit OFFSET :offset""", query, limit, offset)
+
+
+def search_reviews(db, query, limit, offset, book_id=None):
+    return _search(db, """
+        SELECT reviews.id, reviews.book_id, reviews.user_id, reviews.rating,
+               bm25(reviews_fts) AS score,
+               snippet(reviews_fts, 0, :open, :close, :ellipsis, :tokens) AS snippet
+        FROM reviews_fts JOIN reviews ON reviews.id = reviews_fts.rowid
+        WHERE reviews_fts MATCH :query AND (:book_id IS NULL OR reviews.book_id = :book_id)
+        ORDER BY score LIMIT :limit OFFSET :offset""", query, limit, offset, book_id=book_id)
+
+
+def ensure_search_index(db):
+    # databases created before the FTS tables existed (or written with the triggers missing) get reindexed;
+    # the docsize shadow table has one row per indexed document
+    rebuilt = False
+    for table in ("books", "reviews"):
+        indexed = db.execute(text(f"SELECT count(*) FROM {table}_fts_docsize")).scalar()
+        rows = db.execute(text(f"SELECT count(*) FROM {table}")).scalar()
+        if indexed != rows:
+            db.execute(text(f"INSERT INTO {table}_fts ({table}_fts) VALUES ('rebuild')"))
+            rebuilt = True
+    if rebuilt:
+        db.commit()
@@ -0,0 +1,205 @@
+"""
+Synthetic data generator for capacity testing.
+python seed.py --users 100000 --books 50000 --reviews 1000000 --tags 2000 --images 200000 --seed 42
+
+Distributions: tag popularity and reviews per book follow Zipf's law (a few very popular tags/books,
+a long tail of rare ones), ratings are normally distributed around 70, images have 1-10 rectangles
+and 1 + Poisson(2) distinct tags. The same seed always produces the same data.
+Rows are appended in chunks with executemany, one write transaction per chunk. The ids of a chunk continue
+after the current maximum read in the same transaction, so other writers may run in between: the server passes
+run=run_write_blocking (each chunk is a job of its writer thread), the command line takes the write lock itself.
+A running server keeps its in-memory indexes, restart it or use the /seed-database/generate endpoint.
+"""
+import argparse
+import time
+import numpy as np
+from sqlalchemy import select, func
+import change_log
+import models
+import ratings
+import spatial
+from database import engine, WriteSessionLocal
+
+CHUNK_SIZE = 5000
+SQL_IN_CHUNK_SIZE = 900
+ZIPF_EXPONENT = 1.1
+MEAN_EXTRA_TAGS_PER_IMAGE = 2
+MAX_RECTANGLES_PER_IMAGE = 10
+COLORS = ['white', 'yellow', 'red', 'green', 'blue', 'black', 'orange', 'purple', '#ff8800', '#00aaff']
+WORDS = [
+    'river', 'shadow', 'garden', 'winter', 'dragon', 'silver', 'forest', 'ocean', 'secret', 'journey',
+    'empire', 'light', 'stone', 'glass', 'storm', 'night', 'golden', 'wizard', 'hobbit', 'mountain',
+    'city', 'fire', 'star', 'song', 'ghost', 'island', 'queen', 'king', 'clock', 'bridge',
+    'mirror', 'summer', 'wolf', 'raven', 'crown', 'desert', 'harbor', 'lantern', 'orchard', 'valley',
+]
+
+
+def zipf_cdf(n, rng, exponent=ZIPF_EXPONENT, shuffle=False):
+    """Cumulative distribution over n items where the item of rank r has weight 1 / r^exponent."""
+    weights = 1.0 / np.arange(1, n + 1) ** exponent
+    if shuffle:
+        # popularity independent of the id order
+        rng.shuffle(weights)
+    cdf = np.cumsum(weights)
+    return cdf / cdf[-1]
+
+
+def sample(cdf, rng, size):
+    # searchsorted on a precomputed cdf, rng.choice(p=...) would rebuild it on every call
+    return np.minimum(np.searchsorted(cdf, rng.random(size)), len(cdf) - 1)
+
+
+def sentence(rng, words):
+    return ' '.join(WORDS[i] for i in rng.integers(0, len(WORDS), words))
+
+
+def tag_name(i):
+    word = WORDS[i % len(WORDS)]
+    return word if i < len(WORDS) else f"{word}-{i // len(WORDS)}"
+
+
+def next_id(db, model):
+    return (db.execute(select(func.max(model.id))).scalar() or 0) + 1
+
+
+def run_locally(fn):
+    # one write transaction (BEGIN IMMEDIATE on SQLite, see database.py)
+    with WriteSessionLocal.begin() as db:
+        return fn(db)
+
+
+def insert_chunks(table_name, model, count, make_rows, write, report, run):
+    """make_rows(first id, size) is called inside the chunk's transaction, so the ids can't be taken meanwhile."""
+    started = time.perf_counter()
+    for start in range(0, count, CHUNK_SIZE):
+        size = min(CHUNK_SIZE, count - start)
+        run(lambda db: write(db, make_rows(next_id(db, model), size)))
+    seconds = time.perf_counter() - started
+    report[table_name] = {"rows": count, "seconds": seconds, "rows_per_second": count / seconds if seconds else None}
+
+
+def generate_data(users=0, books=0, reviews=0, tags=0, images=0, seed=0, run=run_locally):
+    """Appends the given number of rows of each kind, returns a report with rows/sec per table.
+    run(fn) executes fn(db) in a write transaction and commits it."""
+    rng = np.random.default_rng(seed)
+    report = {}
+    started = time.perf_counter()
+
+    def execute(table):
+        return lambda db, rows: db.execute(table.insert(), rows)
+
+    insert_chunks("users", models.Users, users, lambda first, size: [
+        {"id": first + i, "username": f"user{first + i}", "email": f"user{first + i}@example.com",
+         "password": rng.bytes(8).hex()}
+        for i in range(size)], execute(models.Users.__table__), report, run)
+
+    insert_chunks("books", models.Books, books, lambda first, size: [
+        {"id": first + i, "title": sentence(rng, rng.integers(1, 5)).title(),
+         "author": f"{WORDS[rng.integers(len(WORDS))].title()} {WORDS[rng.integers(len(WORDS))].title()}",
+         "description": sentence(rng, rng.integers(5, 15)), "rating": int(rng.integers(0, 101))}
+        for i in range(size)], execute(models.Books.__table__), report, run)
+
+    user_count, book_count = run(lambda db: (next_id(db, models.Users) - 1, next_id(db, models.Books) - 1))
+
+    if reviews and (user_count == 0 or book_count == 0):
+        raise ValueError("Reviews need at least one user and one book")
+    if reviews:
+        # reviews per book are Zipf-distributed over all books (not only the new ones)
+        book_cdf = zipf_cdf(book_count, rng, shuffle=True)
+
+        def review_rows(first, size):
+            book_ids = sample(book_cdf, rng, size) + 1
+            user_ids = rng.integers(1, user_count + 1, size)
+            review_ratings = np.clip(rng.normal(70, 15, size).round(), 0, 100).astype(int)
+            return [{"id": first + i, "book_id": int(book_ids[i]), "user_id": int(user_ids[i]),
+                     "review": sentence(rng, rng.integers(3, 30)), "rating": int(review_ratings[i])}
+                    for i in range(size)]
+
+        insert_chunks("reviews", models.Reviews, reviews, review_rows, execute(models.Reviews.__table__), report, run)
+        run(ratings.rebuild_rating_stats)
+
+    # tags with the same name are reused, so generating twice doesn't duplicate them
+    tag_names = [tag_name(i) for i in range(tags)]
+    tags_started = time.perf_counter()
+
+    def write_tags(db):
+        tag_ids = {}
+        for start in range(0, len(tag_names), SQL_IN_CHUNK_SIZE):
+            chunk = tag_names[start:start + SQL_IN_CHUNK_SIZE]
+            rows = db.execute(select(models.Tags.tag, func.min(models.Tags.id))
+                              .where(models.Tags.tag.in_(chunk)).group_by(models.Tags.tag))
+            tag_ids.update((tag, tag_id) for tag, tag_id in rows)
+        missing = [name for name in tag_names if name not in tag_ids]
+        first_tag = next_id(db, models.Tags)
+        new_tags = [{"id": first_tag + i, "tag": name} for i, name in enumerate(missing)]
+        if new_tags:
+            db.execute(models.Tags.__table__.insert(), new_tags)
+        tag_ids.update((row["tag"], row["id"]) for row in new_tags)
+        return tag_ids, new_tags
+
+    tag_ids, new_tags = run(write_tags)
+    seconds = time.perf_counter() - tags_started
+    report["tags"] = {"rows": len(new_tags), "seconds": seconds,
+                      "rows_per_second": len(new_tags) / seconds if seconds else None}
+
+    if images:
+        # tag popularity follows the tag order: the first tags are the most popular ones
+        tag_id_by_rank = np.array([tag_ids[name] for name in tag_names], dtype=np.int64)
+        tag_cdf = zipf_cdf(len(tag_names), rng) if tag_names else None
+        max_user = max(user_count, 1)
+
+        def image_rows(first, size):
+            rectangle_counts = rng.integers(1, MAX_RECTANGLES_PER_IMAGE + 1, size)
+            total = int(rectangle_counts.sum())
+            xs, ys = rng.integers(0, 100, total), rng.integers(0, 100, total)
+            widths, heights = rng.integers(1, 201, total), rng.integers(1, 201, total)
+            colors = rng.integers(0, len(COLORS), total)
+            user_ids = rng.integers(1, max_user + 1, size)
+            rows, links, offset = [], [], 0
+            for i in range(size):
+                image_id = first + i
+                end = offset + rectangle_counts[i]
+                rectangles = [{"x": int(x), "y": int(y), "width": int(w), "height": int(h), "color": COLORS[c]}
+                              for x, y, w, h, c in zip(xs[offset:end], ys[offset:end], widths[offset:end],
+                                                       heights[offset:end], colors[offset:end])]
+                offset = end
+                rows.append({"id": image_id, "title": sentence(rng, rng.integers(1, 4)), "user_id": int(user_ids[i]),
+                             "description": sentence(rng, rng.integers(0, 10)), "rectangles": rectangles})
+                if tag_cdf is not None:
+                    ranks = np.unique(sample(tag_cdf, rng, 1 + rng.poisson(MEAN_EXTRA_TAGS_PER_IMAGE)))
+                    links.extend({"image_id": image_id, "tag_id": int(tag_id)} for tag_id in tag_id_by_rank[ranks])
+            return rows, links
+
+        def write_images(db, chunk):
+            rows, links = chunk
+            db.execute(models.Images.__table__.insert(), rows)
+            if links:
+                db.execute(models.image_tag_table.insert(), links)
+            spatial.index_images(db, ((row["id"], row["rectangles"]) for row in rows))
+            db.execute(change_log.changes_table.insert(),
+                       [{"image_id": row["id"], "op": change_log.INSERT} for row in rows])
+
+        insert_chunks("images", models.Images, images, image_rows, write_images, report, run)
+
+    report["total_seconds"] = time.perf_counter() - started
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate synthetic users, books, reviews, tags and images")
+    parser.add_argument("--users", type=int, default=0)
+    parser.add_argument("--books", type=int, default=0)
+    parser.add_argument("--reviews", type=int, default=0)
+    parser.add_argument("--tags", type=int, default=0)
+    parser.add_argument("--images", type=int, default=0)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    models.Base.metadata.create_all(bind=engine)
+    result = generate_data(args.users, args.books, args.reviews, args.tags, args.images, args.seed)
+    for table, stats in result.items():
+        if table == "total_seconds":
+            continue
+        rate = f"{stats['rows_per_second']:.0f} rows/s" if stats['rows_per_second'] else "-"
+        print(f"{table:8} {stats['rows']:>10} rows in {stats['seconds']:.2f}s ({rate})")
+    print(f"total    {result['total_seconds']:.2f}s")
@@ -8,21 +8,64 @@ seed the database with some initial data by visiting http://localhost:8081/seed-
 # -------------------------------------------------------------------------------- #
 import asyncio
 from typing import Annotated
-from fastapi import FastAPI, HTTPException, Depends, WebSocket, WebSocketDisconnect
-from fastapi.responses import HTMLResponse
-from pydantic import BaseModel, Field
+from fastapi import FastAPI, HTTPException, Depends, WebSocket, WebSocketDisconnect, Query, Response, Body, Request
+from fastapi.responses import HTMLResponse, StreamingResponse
+from pydantic import BaseModel, Field, ConfigDict, field_validator, model_validator
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 import models
-from database import engine, SessionLocal
-from sqlalchemy.orm import Session
-from typing import List
+import change_log
+import ratings
+import search
+import seed
+import spatial
+import metrics
+import pubsub
+import render
+from connection_manager import ConnectionManager
+from response_cache import ResponseCache, CachedResponse
+from tag_index import TagIndex
+from tag_stats import TagStats
+from packed_rectangles import RectangleArray, MAX_COORDINATE, MAX_COLORS, MAX_COLOR_LENGTH
+from database import (engine, SessionLocal, ReadSessionLocal, run_read, run_write, run_write_blocking, on_commit,
+                      insert_returning_keys)
+from sqlalchemy import insert, delete, select, func, tuple_
+from sqlalchemy.orm import Session, selectinload
+from typing import List, Literal, Optional
 from fastapi.encoders import jsonable_encoder
 import random
-import json
+import orjson
+import logging
+import os
+import time
+import base64
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager, suppress
+
+logger = logging.getLogger("server")
+
+
+# background tasks living as long as the app (see the websockets section)
+@asynccontextmanager
+async def lifespan(app):
+    await broker.start()
+    tasks = [asyncio.create_task(produce_random_images())]
+    if TAG_REFRESH_INTERVAL > 0:
+        tasks.append(asyncio.create_task(refresh_tag_structures()))
+    yield
+    for task in tasks:
+        task.cancel()
+    with suppress(asyncio.CancelledError):
+        await asyncio.gather(*tasks)
+    await broker.close()
+    if render_pool is not None:
+        render_pool.shutdown(cancel_futures=True)
+
 
 # --------------- fast api config [DON'T TOUCH] --------------- #
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 # ------ Enable CORS ------ #
 app.add_middleware(
@@ -31,11 +74,63 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    # otherwise browsers hide them from cross-origin scripts (the pagination cursors and the cache validator)
+    expose_headers=["ETag", "X-Next-After", "X-Next-Offset"],
 )
 
+# ------ Metrics (Prometheus text format on /metrics) ------ #
+# added last = outermost, so the latency includes the other middlewares
+app.add_middleware(metrics.MetricsMiddleware)
+
+
+@app.get("/metrics", include_in_schema=False)
+def get_metrics():
+    return Response(metrics.render(), media_type="text/plain; version=0.0.4")
+
 # ------------------ database config [DON'T TOUCH] ------------------ #
 # this will create the db and tables if they don't exist (all table models from models.py)
 models.Base.metadata.create_all(bind=engine)
+models.ensure_indexes(engine)
+tag_index = TagIndex()
+tag_stats = TagStats()
+image_changes = change_log.ChangeFeed()
+with SessionLocal() as startup_db:
+    ratings.ensure_rating_stats(startup_db)
+    spatial.ensure_spatial_index(startup_db)
+    search.ensure_search_index(startup_db)
+    tag_index.rebuild(startup_db)
+    tag_stats.rebuild(startup_db)
+    image_changes.reset(change_log.last_seq(startup_db))
+
+
+# The tag index and statistics are updated by the image writes of this process only. With several worker
+# processes the others' writes show up in the change log (see change_log.py), and when there are any both are
+# reloaded from link_tags. The reload runs as a write job: the writer thread serializes it with the writes of this
+# process and their on_commit updates, so none of them gets lost or applied twice. 0 turns it off (a single process).
+TAG_REFRESH_INTERVAL = float(os.environ.get("TAG_REFRESH_INTERVAL", 5))
+
+
+def reload_tag_structures(db):
+    loaded_index, loaded_stats = tag_index.load(db), tag_stats.load(db)
+
+    def committed():
+        tag_index.replace(loaded_index)
+        tag_stats.replace(loaded_stats)
+        response_cache.invalidate("images", "tags")
+
+    on_commit(db, committed)
+    return change_log.last_seq(db)
+
+
+async def refresh_tag_structures():
+    synced = image_changes.head
+    while True:
+        await asyncio.sleep(TAG_REFRESH_INTERVAL)
+        try:
+            if image_changes.others_head(await run_read(change_log.last_seq)) > synced:
+                synced = await run_write(reload_tag_structures)
+        except Exception:
+            logger.exception("Refreshing the tag index and statistics failed")
 
 
 def get_db():
@@ -95,12 +190,97 @@ class Review(BaseModel):
     rating: int = Field(gt=-1, lt=101)
 
 
+class BatchReview(Review):  # POST /book_reviews/batch has the ids in the body
+    book_id: int
+    user_id: int
+
+
 class User(BaseModel):
     username: str = Field(min_length=1, max_length=100)
     # email with regex validation
     email: str = Field(min_length=1, max_length=100, pattern="[^@ \t\r\n]+@[^@ \t\r\n]+\.[^@ \t\r\n]+")
     password: str = Field(min_length=1, max_length=100)
 
+
+# response models: FastAPI validates the returned ORM objects against them (from_attributes) and serializes
+# them straight to JSON bytes in pydantic-core; no input constraints here, stored rows don't have to satisfy them
+class BookOut(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+    id: int
+    title: Optional[str]
+    author: Optional[str]
+    description: Optional[str]
+    rating: Optional[int]
+
+
+class ReviewOut(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+    id: int
+    book_id: Optional[int]
+    user_id: Optional[int]
+    review: Optional[str]
+    rating: Optional[int]
+
+
+class UserOut(BaseModel):  # without the password
+    model_config = ConfigDict(from_attributes=True)
+    id: int
+    username: Optional[str]
+    email: Optional[str]
+
+# -------------------------------------------------------------------------------- #
+# ------------------ Pagination helpers ------------------------------------------ #
+# -------------------------------------------------------------------------------- #
+# List endpoints use keyset pagination on the primary key: `?limit=N&after=<last id>`.
+# The id to pass as `after` for the next page is returned in the X-Next-After header
+# (missing on the last page). GET /, /users and /images without `limit` still return every row (after `after`),
+# as they did before pagination. With `?stream=true` the whole remaining table (after `after`)
+# is streamed as NDJSON, one row per line, read in keyset chunks of STREAM_CHUNK_SIZE rows.
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+STREAM_CHUNK_SIZE = 1000
+NEXT_CURSOR_HEADER = "X-Next-After"
+
+
+def keyset_query(query, key_column, after):
+    if after is not None:
+        query = query.filter(key_column > after)
+    return query.order_by(key_column)
+
+
+def keyset_page(query, key_column, after, limit, response):
+    """Rows after `after`, at most `limit` of them (None = all)."""
+    rows = keyset_query(query, key_column, after).limit(limit).all()
+    if limit is not None and len(rows) == limit:
+        response.headers[NEXT_CURSOR_HEADER] = str(rows[-1].id)
+    return rows
+
+
+def row_serializer(response_model):
+    """row -> dict of the response model's fields, for streams (plain getattr, no validation per row)."""
+    names = tuple(response_model.model_fields)
+    return lambda row: {name: getattr(row, name) for name in names}
+
+
+def stream_ndjson(build_query, key_column, after, serialize):
+    # every chunk is read with a short-lived session whose connection goes back to the read pool before the chunk
+    # is sent, so a slow client doesn't keep one checked out (the pool is shared with all run_read endpoints)
+    def chunks():
+        last = after
+        while True:
+            with ReadSessionLocal() as db:
+                rows = keyset_query(build_query(db), key_column, last).limit(STREAM_CHUNK_SIZE).all()
+                chunk = b"".join(orjson.dumps(serialize(row)) + b"\n" for row in rows)
+            if not rows:
+                return
+            yield chunk
+            if len(rows) < STREAM_CHUNK_SIZE:
+                return
+            last = rows[-1].id
+
+    return StreamingResponse(chunks(), media_type="application/x-ndjson")
+
+
 # -------------------------------------------------------------------------------- #
 # ------------------ API Endpoints ***Edit as needed*** -------------------------- #
 # -------------------------------------------------------------------------------- #
@@ -108,45 +288,57 @@ class User(BaseModel):
 
 # _________ _________ _________ _________ _________ _________ _________ _________ #
 # ^^^^^^^^^^^^^^^^^^^^^^^^^^^^ standard CRUD operations ^^^^^^^^^^^^^^^^^^^^^^^^^^ #                                        <------ # CRUD OPERATIONS #
-@app.get("/")
-def get_all_books(db: Session = Depends(get_db)):
-    return db.query(models.Books).all()
+@app.get("/", response_model=List[BookOut])
+def get_all_books(response: Response, limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+                  after: Optional[int] = None, stream: bool = False, db: Session = Depends(get_db)):
+    if stream:
+        return stream_ndjson(lambda s: s.query(models.Books), models.Books.id, after, row_serializer(BookOut))
+    return keyset_page(db.query(models.Books), models.Books.id, after, limit, response)
 
 
-@app.post("/")
-def create_book(book: Book, db: Session = Depends(get_db)):
-    # tworzymy obiekt modelu z bazy danych
-    book_model = models.Books(title=book.title, author=book.author, description=book.description, rating=book.rating)
-    # teraz trzeba go spushować do bazy danych
-    db.add(book_model)
-    # i zapisać zmiany(!)
-    db.commit()
-
-    return book
+# Writes go through the single writer thread (run_write), like the image writes: the functions below
+# never commit themselves, the writer commits them together with whatever else is queued.
+def insert_book(db, book):
+    # tworzymy obiekt modelu z bazy danych i pushujemy go do bazy danych (commit robi writer)
+    db.add(models.Books(title=book.title, author=book.author, description=book.description, rating=book.rating))
 
 
-@app.put("/{book_id}")
-def update_book(book_id: int, book: Book, db: Session = Depends(get_db)):
+def replace_book(db, book_id, book):
     book_model = db.query(models.Books).filter(models.Books.id == book_id).first()
     if book_model is None:
-        raise HTTPException(status_code=404, detail=f"Book with id {book_id} not found")
-
+        return False
     book_model.title = book.title
     book_model.author = book.author
     book_model.description = book.description
     book_model.rating = book.rating
-    db.commit()
-    return book
+    return True
 
 
-@app.delete("/{book_id}")
-def delete_book(book_id: int, db: Session = Depends(get_db)):
+def remove_book(db, book_id):
     book_model = db.query(models.Books).filter(models.Books.id == book_id).first()
     if book_model is None:
+        return False
+    db.delete(book_model)
+    return True
+
+
+@app.post("/")
+async def create_book(book: Book):
+    await run_write(insert_book, book)
+    return book
+
+
+@app.put("/{book_id}")
+async def update_book(book_id: int, book: Book):
+    if not await run_write(replace_book, book_id, book):
         raise HTTPException(status_code=404, detail=f"Book with id {book_id} not found")
+    return book
 
-    db.delete(book_model)
-    db.commit()
+
+@app.delete("/{book_id}")
+async def delete_book(book_id: int):
+    if not await run_write(remove_book, book_id):
+        raise HTTPException(status_code=404, detail=f"Book with id {book_id} not found")
     return f"Book with id {book_id} deleted"
 
 
@@ -155,60 +347,172 @@ def delete_book(book_id: int, db: Session = Depends(get_db)):
 
 # _________ _________ _________ _________ _________ _________ _________ _________ #
 # ^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^ more CRUD operations ^^^^^^^^^^^^^^^^^^^^^^^^^^^^ #                                        <------ # CRUD OPERATIONS 2 #
-@app.get("/book_reviews/{book_id}")
-def get_book_reviews(book_id: int, db: Session = Depends(get_db)):
-    return db.query(models.Reviews).filter(models.Reviews.book_id == book_id).all()
+# Review listings are keyset-paginated like the other lists: by id (the default, the order they always had),
+# newest first (?sort=recent, the cursor is the review id too) or best rated first (?sort=rating, the cursor is
+# "<rating>:<id>"); all are answered from the composite (book_id | user_id, ...) indexes on reviews.
+# Without `limit` all reviews are returned, as before pagination. The cursor of the next page is in X-Next-After.
+REVIEW_SORTS = Literal["id", "recent", "rating"]
+MAX_REVIEW_BATCH_SIZE = 10000
 
 
-@app.post("/book_reviews/{book_id}/{user_id}")  # common practice is to use path params for (resource) ids
-def create_book_review(book_id: int, user_id: int, review: Review, db: Session = Depends(get_db)):
-    # ensure the user and book exist
-    user = db.query(models.Users).filter(models.Users.id == user_id).first()
+def review_page(query, sort, after, limit, response):
+    try:
+        if sort == "id":
+            if after is not None:
+                query = query.filter(models.Reviews.id > int(after))
+            query = query.order_by(models.Reviews.id)
+        elif sort == "recent":
+            if after is not None:
+                query = query.filter(models.Reviews.id < int(after))
+            query = query.order_by(models.Reviews.id.desc())
+        else:
+            if after is not None:
+                rating, review_id = map(int, after.split(":"))
+                query = query.filter(tuple_(models.Reviews.rating, models.Reviews.id) < tuple_(rating, review_id))
+            query = query.order_by(models.Reviews.rating.desc(), models.Reviews.id.desc())
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Invalid cursor {after!r} for sort={sort}")
+    rows = query.limit(limit).all()
+    if limit is not None and len(rows) == limit:
+        last = rows[-1]
+        response.headers[NEXT_CURSOR_HEADER] = f"{last.rating}:{last.id}" if sort == "rating" else str(last.id)
+    return rows
+
+
+@app.get("/book_reviews/{book_id}", response_model=List[ReviewOut])
+def get_book_reviews(book_id: int, response: Response, sort: REVIEW_SORTS = "id", after: Optional[str] = None,
+                     limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE), db: Session = Depends(get_db)):
+    return review_page(db.query(models.Reviews).filter(models.Reviews.book_id == book_id), sort, after, limit, response)
+
+
+# bulk ingestion: all referenced users and books are checked with one query each, then the reviews
+# and their rating aggregates are written in a single transaction (all or nothing)
+def insert_reviews(db, reviews):
+    """Inserts the reviews and updates the rating aggregates, returns the new ids in input order.
+    Raises a 404 (rolling the whole batch back) if any user or book doesn't exist."""
+    missing_users = missing_ids(db, models.Users, {review.user_id for review in reviews})
+    missing_books = missing_ids(db, models.Books, {review.book_id for review in reviews})
+    if missing_users or missing_books:
+        raise HTTPException(status_code=404, detail={"missing_users": missing_users, "missing_books": missing_books})
+
+    review_ids = insert_returning_keys(db, models.Reviews, models.Reviews.id,
+                                       [review.model_dump() for review in reviews])
+    ratings_by_book = {}
+    for review in reviews:
+        ratings_by_book.setdefault(review.book_id, []).append(review.rating)
+    ratings.record_ratings_by_book(db, ratings_by_book)
+    return review_ids
+
+
+@app.post("/book_reviews/batch")
+async def create_book_reviews(reviews: Annotated[List[BatchReview], Body(max_length=MAX_REVIEW_BATCH_SIZE)]):
+    started = time.perf_counter()
+    review_ids = await run_write(insert_reviews, reviews)
+    seconds = time.perf_counter() - started
+    return {
+        "ids": review_ids,
+        "count": len(review_ids),
+        "seconds": seconds,
+        "reviews_per_second": len(review_ids) / seconds if seconds > 0 else None,
+    }
+
+
+def missing_ids(db, model, ids):
+    # the ids are bound as one JSON array, so a single query checks any number of them
+    requested = func.json_each(orjson.dumps(sorted(ids)).decode()).table_valued("value")
+    found = db.query(model.id).filter(model.id.in_(select(requested.c.value)))
+    return sorted(ids - {row.id for row in found})
+
+
+def insert_review(db, book_id, user_id, review):
+    # ensure the user and book exist (primary key lookups only, the rows themselves aren't needed)
+    user = db.query(models.Users.id).filter(models.Users.id == user_id).first()
     if user is None:
         raise HTTPException(status_code=404, detail=f"User with id {user_id} not found")
 
-    book = db.query(models.Books).filter(models.Books.id == book_id).first()
+    book = db.query(models.Books.id).filter(models.Books.id == book_id).first()
     if book is None:
         raise HTTPException(status_code=404, detail=f"Book with id {book_id} not found")
 
     review_model = models.Reviews(book_id=book_id, user_id=user_id, review=review.review, rating=review.rating)
     db.add(review_model)
-    db.commit()
+    # aggregates are updated in the same transaction as the review itself
+    ratings.record_ratings(db, book_id, [review.rating])
+
+
+@app.post("/book_reviews/{book_id}/{user_id}")  # common practice is to use path params for (resource) ids
+async def create_book_review(book_id: int, user_id: int, review: Review):
+    await run_write(insert_review, book_id, user_id, review)
     return review
 
 
 @app.get("/book_reviews/{book_id}/average_rating")
 def get_book_average_rating(book_id: int, db: Session = Depends(get_db)):
-    reviews = db.query(models.Reviews).filter(models.Reviews.book_id == book_id).all()
-    if len(reviews) == 0:
-        return {"average_rating": 0}
+    stats = db.get(models.BookRatingStats, book_id)
+    return {"average_rating": ratings.average_rating(stats)}
+
+
+# rating stats (count, average, min, max, histogram) of many books in one call:
+# /book_rating_stats?book_ids=1&book_ids=2 (results are in the order of book_ids)
+@app.get("/book_rating_stats")
+def get_book_rating_stats(book_ids: List[int] = Query(max_length=MAX_PAGE_SIZE), db: Session = Depends(get_db)):
+    return ratings.rating_summaries(db, book_ids)
 
-    total_rating = sum([review.rating for review in reviews])
-    return {"average_rating": total_rating / len(reviews)}
 
+@app.get("/user_reviews/{user_id}", response_model=List[ReviewOut])
+def get_user_reviews(user_id: int, response: Response, sort: REVIEW_SORTS = "id", after: Optional[str] = None,
+                     limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE), db: Session = Depends(get_db)):
+    return review_page(db.query(models.Reviews).filter(models.Reviews.user_id == user_id), sort, after, limit, response)
 
-@app.get("/user_reviews/{user_id}")
-def get_user_reviews(user_id: int, db: Session = Depends(get_db)):
-    return db.query(models.Reviews).filter(models.Reviews.user_id == user_id).all()
 
+# full-text search (see search.py): /search?q=wizard harr*&type=books|reviews, best matches first,
+# matched words wrapped in <b></b> in the snippets; the offset of the next page is in X-Next-Offset
+NEXT_OFFSET_HEADER = "X-Next-Offset"
 
-@app.get("/users")
-def get_users(db: Session = Depends(get_db)):
-    return db.query(models.Users).all()
+
+@app.get("/search")
+def search_endpoint(response: Response, q: str = Query(min_length=1, max_length=200),
+                    type: Literal["books", "reviews"] = "books", book_id: Optional[int] = None,
+                    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE), offset: int = Query(0, ge=0),
+                    db: Session = Depends(get_db)):
+    if type == "books":
+        results = search.search_books(db, q, limit, offset)
+    else:
+        results = search.search_reviews(db, q, limit, offset, book_id)
+    if len(results) == limit:
+        response.headers[NEXT_OFFSET_HEADER] = str(offset + limit)
+    return results
+
+
+@app.get("/users", response_model=List[UserOut])
+def get_users(response: Response, limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+              after: Optional[int] = None, stream: bool = False, db: Session = Depends(get_db)):
+    if stream:
+        return stream_ndjson(lambda s: s.query(models.Users), models.Users.id, after, row_serializer(UserOut))
+    return keyset_page(db.query(models.Users), models.Users.id, after, limit, response)
 
 
 # endpoint for creating new user
-@app.post("/users")
-def create_user(user: User, db: Session = Depends(get_db)):
+def insert_user(db, user):
     user_model = models.Users(username=user.username, email=user.email, password=user.password)
     db.add(user_model)
-    db.commit()
-    return user
+    db.flush()  # assigns the id
+    return UserOut.model_validate(user_model)
+
+
+# the created user is returned without the password
+@app.post("/users", response_model=UserOut)
+async def create_user(user: User):
+    return await run_write(insert_user, user)
 
 
 # seed the database with some initial data
 @app.get("/seed-database")
 def seed_database(db: Session = Depends(get_db)):
+    # the fixture is only inserted once
+    if db.query(models.Books.id).filter(models.Books.title == "Harry Potter").first() is not None:
+        return "Database already seeded"
+
     # seed the database with some initial
     user1 = models.Users(username="user1", email="apud123@gmail.com", password="password123")
     user2 = models.Users(username="Zdzichu", email="zzz@gmail.com", password="hahahaha")
@@ -222,10 +526,7 @@ def seed_database(db: Session = Depends(get_db)):
 
     # make sure the book.id and user.id are correct
     db.commit()
-    print('New user id:', user1.id)
-    print('New user id:', user2.id)
-    print('New book id:', book1.id)
-    print('New book id:', book2.id)
+    logger.info("Seeded users %d, %d and books %d, %d", user1.id, user2.id, book1.id, book2.id)
 
     review1 = models.Reviews(book_id=book1.id, user_id=user1.id, review="Great book", rating=90)
     review2 = models.Reviews(book_id=book1.id, user_id=user2.id, review="Good book", rating=80)
@@ -236,11 +537,47 @@ def seed_database(db: Session = Depends(get_db)):
     db.add(review2)
     db.add(review3)
     db.add(review4)
+    ratings.record_ratings(db, book1.id, [review1.rating, review2.rating])
+    ratings.record_ratings(db, book2.id, [review3.rating, review4.rating])
 
     db.commit()
     return "Database seeded"
 
 
+# synthetic data for capacity testing, e.g. /seed-database/generate?users=10000&books=5000&reviews=100000
+# (see seed.py for the distributions; the response reports rows/sec per table)
+# Every chunk is a job of the writer thread, so the other writes go on in between. At most
+# GENERATE_MAX_ROWS rows of each kind per request.
+GENERATE_MAX_ROWS = int(os.environ.get("GENERATE_MAX_ROWS", 1_000_000))
+
+
+def reload_generated(db):
+    # the generated rows bypass the on_commit updates, the in-memory structures have to catch up
+    seq = reload_tag_structures(db)
+
+    def committed():
+        image_changes.reset(seq)
+        response_cache.clear()
+
+    on_commit(db, committed)
+
+
+@app.post("/seed-database/generate")
+def generate_database(users: int = Query(0, ge=0, le=GENERATE_MAX_ROWS),
+                      books: int = Query(0, ge=0, le=GENERATE_MAX_ROWS),
+                      reviews: int = Query(0, ge=0, le=GENERATE_MAX_ROWS),
+                      tags: int = Query(0, ge=0, le=GENERATE_MAX_ROWS),
+                      images: int = Query(0, ge=0, le=GENERATE_MAX_ROWS),
+                      seed_value: int = Query(0, alias="seed")):
+    try:
+        return seed.generate_data(users, books, reviews, tags, images, seed_value, run=run_write_blocking)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    finally:
+        # also after a failure, the chunks committed before it stay
+        run_write_blocking(reload_generated)
+
+
 # _________ _________ _________ _________ _________ _________ _________ _________ #
 
 
@@ -262,27 +599,14 @@ async def async_sleep_1s():
 # _________ _________ _________ _________ _________ _________ _________ _________ #
 # ^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^ websockets! ^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^ #                                           <------ # WEB SOCKETS # 
 
-# ----------- typical manager for websockets [DON'T TOUCH] ---------- #
-class ConnectionManager:
-    def __init__(self):
-        self.active_connections = []
-
-    async def connect(self, websocket):
-        await websocket.accept()
-        self.active_connections.append(websocket)
-
-    def disconnect(self, websocket):
-        self.active_connections.remove(websocket)
+# ----------- manager for websockets (see connection_manager.py) ---------- #
+IMAGE_FEED_INTERVAL = float(os.environ.get("IMAGE_FEED_INTERVAL", 30))  # seconds between new /ws images
 
-    async def send_personal_message(self, message, websocket):
-        await websocket.send_text(message)
-
-    async def broadcast(self, message):
-        for connection in self.active_connections:
-            await connection.send_text(message)
-
-
-manager = ConnectionManager()
+# the chat reaches the clients of all worker processes through the broker (PUBSUB_URL, see pubsub.py);
+# the image feed stays per process, every worker runs its own producer
+broker = pubsub.make_broker()
+manager = ConnectionManager("chat", broker=broker)  # chat clients (/ws/{client_id})
+image_feed = ConnectionManager("image_feed")  # subscribers of new image ids (/ws)
 
 # ----------------- API Websocket Endpoints ***Edit as needed*** ----------------- #
 # -------------------------------------------------------------------------------- #
@@ -336,9 +660,10 @@ async def get():
     return HTMLResponse(html2)
 
 
+# /ws/{client_id}?batch=true: messages arrive coalesced into JSON arrays (see connection_manager.py)
 @app.websocket("/ws/{client_id}")
-async def websocket_endpoint(websocket: WebSocket, client_id: int):
-    await manager.connect(websocket)
+async def websocket_endpoint(websocket: WebSocket, client_id: int, batch: bool = False):
+    await manager.connect(websocket, batch)
     try:
         while True:
             data = await websocket.receive_text()
@@ -350,7 +675,7 @@ async def websocket_endpoint(websocket: WebSocket, client_id: int):
 
 
 async def random_sleep():
-    await asyncio.sleep(30)
+    await asyncio.sleep(IMAGE_FEED_INTERVAL)
 
 
 def random_rectangle():
@@ -367,108 +692,608 @@ def generate_rectangles():
     return [random_rectangle() for _ in range(random.randint(1, 10))]
 
 
-async def generate_random_image(db):
+async def generate_random_image():
     random_image = Image(title="Pozdro", user_id=2, description="600", rectangles=generate_rectangles(), tags=["xd"])
-    await add_image(random_image, db)
+    return await run_write(insert_image, random_image)
+
 
-    return db.query(models.Images).all()[-1].id
+# one producer for the whole app (started in lifespan): every round it creates a single image
+# and publishes its id to all /ws subscribers, no matter how many of them there are
+async def produce_random_images():
+    while True:
+        await random_sleep()
+        if not image_feed.active_connections:
+            continue
+        try:
+            text_id = await generate_random_image()
+        except Exception:
+            # keep the producer alive, the next round will try again
+            logger.exception("Generating a random image failed")
+            continue
+        text_to_send = '[' + str(text_id) + ']'
+        logger.debug("Publishing new image %s", text_id)
+
+        await image_feed.broadcast(text_to_send)
 
 
 @app.websocket("/ws")
-async def websocket_endpoint(websocket: WebSocket, db: Session = Depends(get_db)):
-    await manager.connect(websocket)
+async def websocket_endpoint(websocket: WebSocket):
+    await image_feed.connect(websocket)
     try:
         while True:
-            await random_sleep()
-            text_id = await generate_random_image(db)
-            text_to_send = '[' + str(text_id) + ']'
-            print(text_to_send)
-
-            await manager.broadcast(text_to_send)
+            # the client doesn't send anything, we only wait here to notice the disconnect
+            await websocket.receive_text()
     except WebSocketDisconnect:
-        manager.disconnect(websocket)
+        image_feed.disconnect(websocket)
 
 # ---------------------------------------------------------------------------------------------------------- #
 # ---------------------------------------------------------------------------------------------------------- #
 # ---------------------------------------------------------------------------------------------------------- #
 
 
+# bounded by the packed storage format (see packed_rectangles.py)
 class Rectangle(BaseModel):
-    x: int = Field(gt=-1)
-    y: int = Field(gt=-1)
-    width: int = Field(gt=0)
-    height: int = Field(gt=0)
-    color: str = Field(min_length=1)
+    x: int = Field(gt=-1, le=MAX_COORDINATE)
+    y: int = Field(gt=-1, le=MAX_COORDINATE)
+    width: int = Field(gt=0, le=MAX_COORDINATE)
+    height: int = Field(gt=0, le=MAX_COORDINATE)
+    color: str = Field(min_length=1, max_length=MAX_COLOR_LENGTH)
+
+    # the far edges are stored in the int32 R-tree too (see spatial.py)
+    @model_validator(mode="after")
+    def edges_in_range(self):
+        if self.x + self.width > MAX_COORDINATE or self.y + self.height > MAX_COORDINATE:
+            raise ValueError(f"x + width and y + height must not exceed {MAX_COORDINATE}")
+        return self
 
 
 class Image(BaseModel):
     title: str = Field(min_length=1)
     user_id: int = Field(gt=-1)
     description: str = Field(min_length=0)
-    rectangles: List[Rectangle] = Field(min_items=0)
+    rectangles: List[Rectangle] = Field(min_items=0, max_length=spatial.MAX_RECTANGLES_PER_IMAGE)
     tags: List[str] = Field(min_items=0)
 
+    @field_validator("rectangles")
+    @classmethod
+    def few_enough_colors(cls, rectangles):
+        if len({rectangle.color for rectangle in rectangles}) > MAX_COLORS:
+            raise ValueError(f"at most {MAX_COLORS} distinct colors per image")
+        return rectangles
+
+
+class RectangleOut(BaseModel):
+    x: int
+    y: int
+    width: int
+    height: int
+    color: str
+
+
+class ImageOut(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+    id: int
+    title: Optional[str]
+    user_id: Optional[int]
+    description: Optional[str]
+    rectangles: List[RectangleOut]
+    tags: List[str]
+
+    @field_validator("rectangles", mode="before")
+    @classmethod
+    def unpack_rectangles(cls, value):
+        if value is None:
+            return []
+        return value.tolist() if isinstance(value, models.RectangleArray) else value
+
+    @field_validator("tags", mode="before")
+    @classmethod
+    def tag_names(cls, value):
+        return [tag.tag if isinstance(tag, models.Tags) else tag for tag in value]
+
+
+MAX_IMAGE_BATCH_SIZE = 10000
+# GET /images/{id} fails / answers after 10 s for this % of requests, so that clients get tested against it
+# (the benchmark turns both off)
+IMAGE_FAILURE_PERCENT = int(os.environ.get("IMAGE_FAILURE_PERCENT", 25))
+IMAGE_DELAY_PERCENT = int(os.environ.get("IMAGE_DELAY_PERCENT", 25))
+SQL_IN_CHUNK_SIZE = 900  # stays below SQLite's limit of bound parameters per statement
+
+
+# serialized responses of the image/tag reads, invalidated by the image writes (see response_cache.py)
+response_cache = ResponseCache()
+# rendered PNG/BMP images, invalidated by the updates and deletes of the image (see render.py)
+render_cache = render.RenderCache()
+# batch thumbnails are rasterized by worker processes, so they neither block the event loop nor share the GIL
+# with it; spawned (not forked) because the server process has threads, created on the first batch
+RENDER_WORKERS = int(os.environ.get("RENDER_WORKERS", os.cpu_count() or 1))
+MAX_THUMBNAIL_BATCH_SIZE = 500
+MAX_THUMBNAIL_SIZE = 512
+render_pool = None
+
+
+async def cached_renders(keys):
+    """{key: render} of the cached ones; the disk part of the render cache is read in a thread."""
+    found = {}
+    for key in keys:
+        data = render_cache.get(key)
+        if data is not None:
+            found[key] = data
+    missing = [key for key in keys if key not in found]
+    if missing and render_cache.directory is not None:
+        found.update(await asyncio.to_thread(render_cache.read, missing))
+    return found
+
+
+async def cache_renders(renders, generation):
+    def put_all():
+        for key, data in renders:
+            render_cache.put(key, data, generation)
+
+    if render_cache.directory is None:
+        put_all()
+    else:
+        await asyncio.to_thread(put_all)
+
+
+def get_render_pool():
+    global render_pool
+    if render_pool is None:
+        render_pool = ProcessPoolExecutor(RENDER_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return render_pool
+
+
+def drop_render_pool(pool):
+    # a pool whose worker died (killed, out of memory, ...) stays broken, the next batch gets a new one
+    global render_pool
+    if render_pool is pool:
+        render_pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+async def cached_response(request, key, dependencies, produce):
+    """Serves `key` from the cache (or a 304 for a matching If-None-Match), otherwise awaits
+    produce() -> (content, headers) and caches the JSON-encoded content (a response model or plain data)."""
+    entry = response_cache.get(key)
+    if entry is None:
+        generation = response_cache.generation()
+        content, headers = await produce()
+        body = content.model_dump_json().encode() if isinstance(content, BaseModel) else orjson.dumps(content)
+        entry = response_cache.put(key, body, headers, dependencies, generation)
+    return entry.to_response(request)
+
+
+# The image endpoints are `async def`, so they must never touch a blocking Session on the event loop.
+# Their DB work lives in the plain functions below and runs on the DB thread pool (run_read)
+# or the single writer thread (run_write, so these functions never commit themselves).
+def load_image(db, picture_id):
+    # tags in one extra SELECT ... IN instead of a lazy load; converted while the session is still open
+    res = db.query(models.Images).options(selectinload(models.Images.tags)) \
+        .filter(models.Images.id == picture_id).first()
+    return None if res is None else ImageOut.model_validate(res)
+
+
+def load_rectangles(db, image_ids):
+    """image id -> RectangleArray of the image, only the rectangles column is read (unknown ids are left out)."""
+    found = {}
+    for chunk in chunked(list(set(image_ids)), SQL_IN_CHUNK_SIZE):
+        for image_id, rectangles in db.query(models.Images.id, models.Images.rectangles) \
+                .filter(models.Images.id.in_(chunk)):
+            found[image_id] = rectangles if rectangles is not None else RectangleArray.from_list([])
+    return found
+
+
+def chunked(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def resolve_tag_ids(db, names):
+    """(tag name -> tag id for all the given names, names of newly inserted tags);
+    one IN query (per chunk) plus one bulk insert of missing tags."""
+    names = list(set(names))
+    tag_ids = {}
+    for chunk in chunked(names, SQL_IN_CHUNK_SIZE):
+        # descending, so that the oldest tag wins if the same name was inserted twice
+        rows = db.query(models.Tags.tag, models.Tags.id).filter(models.Tags.tag.in_(chunk)).order_by(models.Tags.id.desc())
+        tag_ids.update((tag, tag_id) for tag, tag_id in rows)
+    missing = [name for name in names if name not in tag_ids]
+    if missing:
+        inserted = db.execute(insert(models.Tags).returning(models.Tags.tag, models.Tags.id),
+                              [{"tag": name} for name in missing])
+        tag_ids.update((tag, tag_id) for tag, tag_id in inserted)
+    return tag_ids, missing
+
+
+def insert_images(db, images):
+    """Inserts all images with their tag links, returns the new ids in input order."""
+    if not images:
+        return []
+    tag_ids, new_tags = resolve_tag_ids(db, [tag for image in images for tag in image.tags])
+    image_ids = insert_returning_keys(db, models.Images, models.Images.id, [
+        {"title": image.title, "user_id": image.user_id, "description": image.description,
+         "rectangles": jsonable_encoder(image.rectangles)} for image in images])
+    links = [{"image_id": image_id, "tag_id": tag_ids[tag]}
+             for image_id, image in zip(image_ids, images) for tag in set(image.tags)]
+    if links:
+        db.execute(models.image_tag_table.insert(), links)
+    spatial.index_images(db, ((image_id, jsonable_encoder(image.rectangles))
+                              for image_id, image in zip(image_ids, images)))
+    change_log.record_changes(db, image_ids, change_log.INSERT, image_changes)
+
+    def committed():
+        for image_id, image in zip(image_ids, images):
+            tag_index.add_image(image_id, image.tags)
+            tag_stats.add_image(image.tags)
+        response_cache.invalidate("images", *(["tags"] if new_tags else []))
+
+    on_commit(db, committed)
+    return image_ids
+
+
+def insert_image(db, image):
+    return insert_images(db, [image])[0]
+
+
+def list_image_ids(db, after, limit):
+    # only the id column is selected, no need to decode rectangles of every row
+    return [row.id for row in keyset_query(db.query(models.Images.id), models.Images.id, after).limit(limit)]
+
+
+def list_tags(db):
+    return [tag for tag, in db.query(models.Tags.tag)]
+
+
+def remove_image(db, image_id):
+    to_delete = db.query(models.Images).filter(models.Images.id == image_id).first()
+    if to_delete is None:
+        return False
+    tags = [tag.tag for tag in to_delete.tags]
+    spatial.unindex_image(db, image_id, len(to_delete.rectangles or []))
+    db.delete(to_delete)
+    change_log.record_changes(db, [image_id], change_log.DELETE, image_changes)
+
+    def committed():
+        tag_index.remove_image(image_id, tags)
+        tag_stats.remove_image(tags)
+        response_cache.invalidate(("image", image_id), "images")
+        render_cache.invalidate(image_id)
+
+    on_commit(db, committed)
+    return True
+
+
+IMAGE_FIELDS = ("title", "user_id", "description", "rectangles", "tags")
+
+
+def fetch_images(db, image_ids, fields):
+    """Images in the order of image_ids with only the requested fields, {"id": ..., "missing": true} for unknown ids.
+    One IN query per chunk for the rows (only the selected columns, so rectangles aren't decoded unless asked for)
+    and one for the tags of the whole chunk."""
+    columns = [getattr(models.Images, field) for field in fields if field != "tags"]
+    found = {}
+    for chunk in chunked(list(set(image_ids)), SQL_IN_CHUNK_SIZE):
+        for row in db.query(models.Images.id, *columns).filter(models.Images.id.in_(chunk)):
+            image = row._asdict()
+            if "rectangles" in image:
+                image["rectangles"] = image["rectangles"].tolist() if image["rectangles"] is not None else []
+            if "tags" in fields:
+                image["tags"] = []
+            found[row.id] = image
+        if "tags" in fields:
+            links = db.query(models.image_tag_table.c.image_id, models.Tags.tag) \
+                .join(models.Tags, models.Tags.id == models.image_tag_table.c.tag_id) \
+                .filter(models.image_tag_table.c.image_id.in_(chunk))
+            for image_id, tag in links:
+                found[image_id]["tags"].append(tag)
+    return [found.get(image_id) or {"id": image_id, "missing": True} for image_id in image_ids]
+
+
+def replace_image(db, image_id, image):
+    """Replaces all fields, rectangles and tags of the image (False if there's no such image)."""
+    image_model = db.query(models.Images).options(selectinload(models.Images.tags)) \
+        .filter(models.Images.id == image_id).first()
+    if image_model is None:
+        return False
+    old_tags = [tag.tag for tag in image_model.tags]
+    spatial.unindex_image(db, image_id, len(image_model.rectangles or []))
+    rectangles = jsonable_encoder(image.rectangles)
+    image_model.title = image.title
+    image_model.user_id = image.user_id
+    image_model.description = image.description
+    image_model.rectangles = rectangles
+    tag_ids, new_tags = resolve_tag_ids(db, image.tags)
+    db.execute(delete(models.image_tag_table).where(models.image_tag_table.c.image_id == image_id))
+    if image.tags:
+        db.execute(models.image_tag_table.insert(), [{"image_id": image_id, "tag_id": tag_ids[tag]}
+                                                     for tag in set(image.tags)])
+    spatial.index_images(db, [(image_id, rectangles)])
+    change_log.record_changes(db, [image_id], change_log.UPDATE, image_changes)
+
+    def committed():
+        tag_index.remove_image(image_id, old_tags)
+        tag_index.add_image(image_id, image.tags)
+        tag_stats.remove_image(old_tags)
+        tag_stats.add_image(image.tags)
+        response_cache.invalidate(("image", image_id), "images", *(["tags"] if new_tags else []))
+        render_cache.invalidate(image_id)
+
+    on_commit(db, committed)
+    return True
+
 
 # 1. Daj obrazek o konkretnym id
-@app.get('/images/{picture_id}')
-async def get_image_by_id_endpoint(picture_id: int, db: Session = Depends(get_db)):
-    if random.randrange(100) < 25:
+# (`:int` so that the fixed /images/... routes below aren't swallowed by this one)
+@app.get('/images/{picture_id:int}', response_model=ImageOut)
+async def get_image_by_id_endpoint(picture_id: int, request: Request):
+    if random.randrange(100) < IMAGE_FAILURE_PERCENT:
         raise HTTPException(status_code=500, detail='dupa')
 
-    if random.randrange(100) < 25:
+    if random.randrange(100) < IMAGE_DELAY_PERCENT:
         await asyncio.sleep(10)
 
-    res = db.query(models.Images).filter(models.Images.id == picture_id).first()
-    if res is None:
-        return HTTPException(status_code=404, detail='Not found')
-    return res
+    async def produce():
+        res = await run_read(load_image, picture_id)
+        if res is None:
+            raise HTTPException(status_code=404, detail='Not found')
+        return res, {}
+
+    return await cached_response(request, ("image", picture_id), [("image", picture_id)], produce)
+
+# 1b. Wiele obrazków naraz: POST /images/fetch {"ids": [3, 1, 2], "fields": ["title", "tags"]}
+# -> the images in the order of ids, unknown ids as {"id": ..., "missing": true}; all fields by default
+@app.post('/images/fetch')
+async def fetch_images_endpoint(ids: Annotated[List[int], Body(max_length=MAX_PAGE_SIZE)],
+                                fields: Annotated[Optional[List[Literal[IMAGE_FIELDS]]], Body()] = None):
+    images = await run_read(fetch_images, ids, set(fields) if fields is not None else set(IMAGE_FIELDS))
+    return Response(orjson.dumps(images), media_type="application/json")
+
+
+# 1c. Obrazek jako PNG/BMP: /images/{id}/render?w=&h=&format=png
+# no size = the drawing's own extent, one side only = keeps the aspect ratio; rendered once, then served
+# from the render cache until the image changes
+RENDER_FORMATS = Literal[tuple(render.FORMATS)]
+
+
+@app.get('/images/{picture_id:int}/render')
+async def render_image_endpoint(picture_id: int, request: Request,
+                                w: Optional[int] = Query(None, ge=1, le=render.MAX_RENDER_SIZE),
+                                h: Optional[int] = Query(None, ge=1, le=render.MAX_RENDER_SIZE),
+                                image_format: RENDER_FORMATS = Query("png", alias="format")):
+    key = (picture_id, w, h, image_format)
+    data = (await cached_renders([key])).get(key)
+    if data is None:
+        generation = render_cache.generation()
+        rectangles = (await run_read(load_rectangles, [picture_id])).get(picture_id)
+        if rectangles is None:
+            raise HTTPException(status_code=404, detail='Not found')
+        # NumPy releases the GIL for the fills and zlib for the compression, a thread is enough here
+        data = await asyncio.to_thread(render.render, rectangles, w, h, image_format)
+        await cache_renders([(key, data)], generation)
+    return CachedResponse(data, {}, None, ()).to_response(request, render.FORMATS[image_format])
+
+
+# 1d. Miniaturki wielu obrazków: POST /images/thumbnails {"ids": [3, 1, 2], "w": 128, "h": 128}
+# -> [{"id": 3, "png": "<base64>"}, ...] in the order of ids, unknown ids as {"id": ..., "missing": true};
+# cached thumbnails are reused, the rest is loaded in one query and rendered in parallel by the render pool
+def thumbnail_jobs(rectangles_by_id, w, h, chunks):
+    jobs = [((image_id, w, h, "png"), rectangles.to_bytes(), w, h, "png")
+            for image_id, rectangles in rectangles_by_id.items()]
+    size = max(1, -(-len(jobs) // chunks))
+    return list(chunked(jobs, size))
+
+
+@app.post('/images/thumbnails')
+async def thumbnails_endpoint(ids: Annotated[List[int], Body(max_length=MAX_THUMBNAIL_BATCH_SIZE)],
+                              w: Annotated[int, Body(ge=1, le=MAX_THUMBNAIL_SIZE)] = 128,
+                              h: Annotated[Optional[int], Body(ge=1, le=MAX_THUMBNAIL_SIZE)] = None):
+    cached = await cached_renders([(image_id, w, h, "png") for image_id in dict.fromkeys(ids)])
+    rendered = {key[0]: data for key, data in cached.items()}
+    missing = [image_id for image_id in ids if image_id not in rendered]
+    if missing:
+        generation = render_cache.generation()
+        rectangles_by_id = await run_read(load_rectangles, missing)
+        loop = asyncio.get_running_loop()
+        pool = get_render_pool()
+        try:
+            results = await asyncio.gather(*(loop.run_in_executor(pool, render.render_blobs, jobs)
+                                             for jobs in thumbnail_jobs(rectangles_by_id, w, h, RENDER_WORKERS)))
+        except BrokenProcessPool:
+            drop_render_pool(pool)
+            raise HTTPException(status_code=503, detail='Render workers failed, try again')
+        renders = [result for chunk in results for result in chunk]
+        await cache_renders(renders, generation)
+        rendered.update((key[0], data) for key, data in renders)
+    return Response(orjson.dumps([{"id": image_id, "png": base64.b64encode(rendered[image_id]).decode()}
+                                  if image_id in rendered else {"id": image_id, "missing": True}
+                                  for image_id in ids]), media_type="application/json")
+
 
 # 2. Daj listę dostępnych id
 
 # 3. Dodaj obrazek (z nowym id z DB)
-from typing import Dict, Any
-
 @app.post('/images')
-async def add_image(image: Image, db: Session = Depends(get_db)):
-    tag_models = []
-    for tag in image.tags:
-        tag_model = db.query(models.Tags).filter(models.Tags.tag == tag).first()
-        if tag_model is None:
-            tag_model = models.Tags(tag=tag)
-            db.add(tag_model)
-            tag_models.append(tag_model)
-    image_model = models.Images(title=image.title, user_id=image.user_id,
-        description=image.description, tags=tag_models, rectangles=jsonable_encoder(image.rectangles))
-    db.add(image_model)
-    db.commit()
+async def add_image(image: Image):
+    await run_write(insert_image, image)
 
 
+# bulk ingestion, e.g. of labelled datasets: all images of the batch are inserted in one transaction
+@app.post('/images/batch')
+async def add_images(images: Annotated[List[Image], Body(max_length=MAX_IMAGE_BATCH_SIZE)]):
+    started = time.perf_counter()
+    image_ids = await run_write(insert_images, images)
+    seconds = time.perf_counter() - started
+    return {
+        "ids": image_ids,
+        "count": len(image_ids),
+        "seconds": seconds,
+        "images_per_second": len(image_ids) / seconds if seconds > 0 else None,
+    }
+
+
+# ?tags=a&tags=b -> ids of images that have all of the given tags (answered from the in-memory tag index),
+# no tags -> all images
 @app.get('/images')
-async def get_images(db: Session = Depends(get_db)):
-    images = db.query(models.Images).all()
-    return [image.id for image in images]
+async def get_images(request: Request, limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+                     after: Optional[int] = None, stream: bool = False, tags: List[str] = Query([])):
+    if stream:
+        if tags:
+            return StreamingResponse((b"%d\n" % image_id for image_id in tag_index.image_ids(tags, after)),
+                                     media_type="application/x-ndjson")
+        # the NDJSON generator is iterated in a worker thread by the StreamingResponse
+        return stream_ndjson(lambda s: s.query(models.Images.id), models.Images.id, after, lambda row: row.id)
+
+    async def produce():
+        if tags:
+            image_ids = tag_index.image_ids(tags, after)
+            if limit is not None and len(image_ids) > limit:
+                return image_ids[:limit], {NEXT_CURSOR_HEADER: str(image_ids[limit - 1])}
+            return image_ids, {}
+        image_ids = await run_read(list_image_ids, after, limit)
+        if limit is not None and len(image_ids) == limit:
+            return image_ids, {NEXT_CURSOR_HEADER: str(image_ids[-1])}
+        return image_ids, {}
+
+    return await cached_response(request, ("images", tuple(sorted(set(tags))), after, limit), ["images"], produce)
+
+
+# spatial queries over image rectangles, answered from the R-tree (see spatial.py);
+# results are sorted image ids, paginated like GET /images
+def page_of_ids(image_ids, limit, response):
+    if len(image_ids) == limit:
+        response.headers[NEXT_CURSOR_HEADER] = str(image_ids[-1])
+    return image_ids
+
+
+# images with a rectangle containing the point (x, y)
+@app.get('/images/spatial/point')
+async def get_images_at_point(response: Response, x: int, y: int,
+                              limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE), after: Optional[int] = None):
+    image_ids = await run_read(spatial.images_containing_point, x, y, after, limit)
+    return page_of_ids(image_ids, limit, response)
+
+
+# images with a rectangle intersecting the region
+@app.get('/images/spatial/region')
+async def get_images_in_region(response: Response, x: int, y: int,
+                               width: int = Query(gt=0, le=MAX_COORDINATE), height: int = Query(gt=0, le=MAX_COORDINATE),
+                               limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE), after: Optional[int] = None):
+    image_ids = await run_read(spatial.images_intersecting_region, x, y, width, height, after, limit)
+    return page_of_ids(image_ids, limit, response)
+
+
+# images whose rectangles (together) cover more than min_percent % of the region
+# (400 when the region intersects more than spatial.MAX_COVERAGE_RECTANGLES rectangles)
+@app.get('/images/spatial/coverage')
+async def get_images_by_coverage(response: Response, min_percent: float = Query(ge=0, lt=100),
+                                 x: int = 0, y: int = 0,
+                                 width: int = Query(300, gt=0, le=MAX_COORDINATE),
+                                 height: int = Query(300, gt=0, le=MAX_COORDINATE),
+                                 limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE), after: Optional[int] = None):
+    try:
+        image_ids = await run_read(spatial.images_covering_region, x, y, width, height, min_percent, after, limit)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return page_of_ids(image_ids, limit, response)
 
 
 # 4. Podaj listę dostępnych tagów
 @app.get('/tags')
-async def get_tags(db: Session = Depends(get_db)):
-    tags = db.query(models.Tags).all()
-    return [tag.tag for tag in tags]
+async def get_tags(request: Request):
+    async def produce():
+        return await run_read(list_tags), {}
+
+    return await cached_response(request, ("tags",), ["tags"], produce)
+
+
+# 4b. Statystyki tagów, answered from memory (see tag_stats.py):
+# /tags/stats?limit=&prefix= -> [{"tag": ..., "images": n}, ...] most used first (prefix = autocomplete),
+# /tags/{tag}/related?limit= -> [{"tag": ..., "images": n}, ...] tags most often on the same images as tag (n of them)
+def tag_counts_response(counts):
+    return Response(orjson.dumps([{"tag": tag, "images": count} for tag, count in counts]),
+                    media_type="application/json")
+
+
+@app.get('/tags/stats')
+async def get_tag_stats(limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE), prefix: str = ""):
+    return tag_counts_response(tag_stats.top(limit, prefix))
+
+
+@app.get('/tags/{tag:path}/related')  # `:path`, tag names may contain slashes
+async def get_related_tags(tag: str, limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE)):
+    related = tag_stats.related(tag, limit)
+    if related is None:
+        raise HTTPException(status_code=404, detail='Unknown tag')
+    return tag_counts_response(related)
 
 
 # 5. Usuń obrazek
-@app.delete('/images/{image_id}')
-async def delete_image(image_id: int, db: Session = Depends(get_db)):
-    to_delete = db.query(models.Images).filter(models.Images.id == image_id).first()
-    if to_delete is None:
-        return HTTPException(status_code=404)
-    db.delete(to_delete)
-    db.commit()
+@app.delete('/images/{image_id:int}')
+async def delete_image(image_id: int):
+    if not await run_write(remove_image, image_id):
+        raise HTTPException(status_code=404)
 
 # 6. Zmodyfikuj obrazek
-@app.put('/iamges/{image_id}')
-async def update_image(image_id: int):
-    pass
+@app.put('/images/{image_id:int}')
+async def update_image(image_id: int, image: Image):
+    if not await run_write(replace_image, image_id, image):
+        raise HTTPException(status_code=404)
+    return image
+
+
+# 7. Zmiany od ostatniej synchronizacji: /images/changes?since=<seq> -> [{seq, image_id, op}, ...]
+# (op = insert / update / delete, oldest first). Clients remember the seq of the last change they applied;
+# while a page is full the X-Next-After header has the `since` of the next one.
+async def read_changes(since, limit):
+    changes = image_changes.after(since, limit)
+    if changes is None:
+        return await run_read(change_log.list_changes, since, limit)
+    if len(changes) < limit:
+        # other processes may have written after the last change in memory
+        last = changes[-1]["seq"] if changes else since
+        changes = changes + await run_read(change_log.list_changes, last, limit - len(changes))
+    return changes
+
+
+@app.get('/images/changes')
+async def get_image_changes(response: Response, since: int = Query(0, ge=0),
+                            limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE)):
+    changes = await read_changes(since, limit)
+    if len(changes) == limit:
+        response.headers[NEXT_CURSOR_HEADER] = str(changes[-1]["seq"])
+    return changes
+
+
+# the same feed pushed: every frame is a JSON array of changes, first the backlog after `since`,
+# then new changes as they are committed
+@app.websocket('/ws/images/changes')
+async def image_changes_websocket(websocket: WebSocket, since: int = Query(0, ge=0)):
+    await websocket.accept()
+
+    async def push():
+        last = since
+        fresh = False  # after a wakeup by our own commit the new changes are in memory
+        while True:
+            changes = image_changes.after(last, MAX_PAGE_SIZE) if fresh else None
+            if changes is None:
+                changes = await run_read(change_log.list_changes, last, MAX_PAGE_SIZE)
+            if changes:
+                await websocket.send_text(orjson.dumps(changes).decode())
+                last = changes[-1]["seq"]
+                continue
+            fresh = await image_changes.wait()
+
+    pusher = asyncio.create_task(push())
+    try:
+        while True:
+            # nothing is expected from the client, only the disconnect
+            await websocket.receive_text()
+    except WebSocketDisconnect:
+        pass
+    finally:
+        pusher.cancel()
+        with suppress(asyncio.CancelledError, Exception):
+            await pusher
 
 
 # ---------------------
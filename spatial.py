@@ -0,0 +1,145 @@
+import os
+import numpy as np
+from sqlalchemy import text, select
+import models
+
+# ------------------------- R-tree over image rectangles ------------------------- #
+# Every rectangle of every image is one entry of the SQLite rtree_i32 virtual table `image_rectangles_rtree`
+# (created in models.py). A rectangle covers [x, x + width) x [y, y + height).
+# The entry id encodes the owner: image_id << RECTANGLE_ID_BITS | index of the rectangle in the image,
+# so the image id comes for free with every hit and deleting an image is a few primary key lookups.
+# Entries are written in the same transaction as the image row itself.
+RECTANGLE_ID_BITS = 20
+MAX_RECTANGLES_PER_IMAGE = 1 << RECTANGLE_ID_BITS
+BACKFILL_CHUNK_SIZE = 1000
+# the coverage query computes exact unions, in time quadratic in the rectangles of an image; a region
+# intersecting more rectangles than this (of all images together) is rejected
+MAX_COVERAGE_RECTANGLES = int(os.environ.get("MAX_COVERAGE_RECTANGLES", 10000))
+
+_insert_entry = text("INSERT INTO image_rectangles_rtree (id, min_x, max_x, min_y, max_y) "
+                     "VALUES (:id, :min_x, :max_x, :min_y, :max_y)")
+_delete_entry = text("DELETE FROM image_rectangles_rtree WHERE id = :id")
+
+
+def _entries(image_id, rectangles):
+    if len(rectangles) > MAX_RECTANGLES_PER_IMAGE:
+        raise ValueError(f"Image {image_id} has more than {MAX_RECTANGLES_PER_IMAGE} rectangles")
+    base = image_id << RECTANGLE_ID_BITS
+    return [{"id": base | i, "min_x": r['x'], "max_x": r['x'] + r['width'],
+             "min_y": r['y'], "max_y": r['y'] + r['height']} for i, r in enumerate(rectangles)]
+
+
+def index_images(db, images):
+    """images: iterable of (image_id, rectangles as dicts or RectangleArray)"""
+    entries = [entry for image_id, rectangles in images for entry in _entries(image_id, rectangles)]
+    if entries:
+        db.execute(_insert_entry, entries)
+
+
+def unindex_image(db, image_id, rectangle_count):
+    base = image_id << RECTANGLE_ID_BITS
+    if rectangle_count:
+        db.execute(_delete_entry, [{"id": base | i} for i in range(rectangle_count)])
+
+
+def rebuild_spatial_index(db):
+    """Re-indexes all images from their rectangles, chunk by chunk (does not commit)."""
+    db.execute(text("DELETE FROM image_rectangles_rtree"))
+    last_id = 0
+    while True:
+        rows = db.execute(select(models.Images.id, models.Images.rectangles)
+                          .where(models.Images.id > last_id).order_by(models.Images.id)
+                          .limit(BACKFILL_CHUNK_SIZE)).all()
+        if not rows:
+            return
+        index_images(db, ((image_id, rectangles or []) for image_id, rectangles in rows))
+        last_id = rows[-1].id
+
+
+def ensure_spatial_index(db):
+    # databases created before the R-tree existed have images but no entries yet
+    has_entries = db.execute(text("SELECT 1 FROM image_rectangles_rtree LIMIT 1")).first() is not None
+    has_images = db.execute(select(models.Images.id).limit(1)).first() is not None
+    if has_images and not has_entries:
+        rebuild_spatial_index(db)
+        db.commit()
+
+
+def images_containing_point(db, x, y, after, limit):
+    return db.execute(text(
+        "SELECT DISTINCT id >> :bits AS image_id FROM image_rectangles_rtree "
+        "WHERE min_x <= :x AND max_x > :x AND min_y <= :y AND max_y > :y AND (id >> :bits) > :after "
+        "ORDER BY image_id LIMIT :limit"),
+        {"bits": RECTANGLE_ID_BITS, "x": x, "y": y, "after": after or 0, "limit": limit}).scalars().all()
+
+
+def _intersecting_entries(db, x, y, width, height, limit=None):
+    return db.execute(text(
+        "SELECT id, min_x, max_x, min_y, max_y FROM image_rectangles_rtree "
+        "WHERE min_x < :max_x AND max_x > :x AND min_y < :max_y AND max_y > :y LIMIT :limit"),
+        {"x": x, "y": y, "max_x": x + width, "max_y": y + height, "limit": -1 if limit is None else limit})
+
+
+def images_intersecting_region(db, x, y, width, height, after, limit):
+    return db.execute(text(
+        "SELECT DISTINCT id >> :bits AS image_id FROM image_rectangles_rtree "
+        "WHERE min_x < :max_x AND max_x > :x AND min_y < :max_y AND max_y > :y AND (id >> :bits) > :after "
+        "ORDER BY image_id LIMIT :limit"),
+        {"bits": RECTANGLE_ID_BITS, "x": x, "y": y, "max_x": x + width, "max_y": y + height,
+         "after": after or 0, "limit": limit}).scalars().all()
+
+
+def union_area(boxes):
+    """Area covered by the union of boxes, an (n, 4) array of min_x, max_x, min_y, max_y.
+    Sweep line over x: every box edge updates a coverage count per elementary y interval, between two
+    consecutive edges the covered height is constant. Memory stays linear in n, time is quadratic
+    (see MAX_COVERAGE_RECTANGLES)."""
+    boxes = boxes[(boxes[:, 1] > boxes[:, 0]) & (boxes[:, 3] > boxes[:, 2])]
+    ys = np.unique(boxes[:, 2:])
+    heights = np.diff(ys)
+    y_from, y_to = np.searchsorted(ys, boxes[:, 2]).tolist(), np.searchsorted(ys, boxes[:, 3]).tolist()
+    # (x, +1 entering / -1 leaving, box)
+    events = sorted([(x, 1, i) for i, x in enumerate(boxes[:, 0].tolist())] +
+                    [(x, -1, i) for i, x in enumerate(boxes[:, 1].tolist())])
+    counts = np.zeros(len(heights), dtype=np.int64)
+    area, previous_x = 0, None
+    for x, delta, i in events:
+        if previous_x is not None and x != previous_x:
+            area += int(heights @ (counts > 0)) * (x - previous_x)
+        counts[y_from[i]:y_to[i]] += delta
+        previous_x = x
+    return float(area)
+
+
+def images_covering_region(db, x, y, width, height, min_percent, after, limit):
+    """Ids of images whose rectangles cover more than min_percent of the region.
+    ValueError when the region intersects more than MAX_COVERAGE_RECTANGLES rectangles."""
+    rows = _intersecting_entries(db, x, y, width, height, MAX_COVERAGE_RECTANGLES + 1).all()
+    if not rows:
+        return []
+    if len(rows) > MAX_COVERAGE_RECTANGLES:
+        raise ValueError(f"The region intersects more than {MAX_COVERAGE_RECTANGLES} rectangles, narrow it")
+    entries = np.array(rows, dtype=np.int64)
+    boxes = entries[:, 1:].copy()
+    # clip to the region, only the covered part of the region counts
+    np.clip(boxes[:, :2], x, x + width, out=boxes[:, :2])
+    np.clip(boxes[:, 2:], y, y + height, out=boxes[:, 2:])
+    image_ids = entries[:, 0] >> RECTANGLE_ID_BITS
+    order = np.argsort(image_ids, kind='stable')
+    image_ids, boxes = image_ids[order], boxes[order]
+    starts = np.flatnonzero(np.r_[True, image_ids[1:] != image_ids[:-1]])
+
+    threshold = width * height * min_percent / 100
+    areas = (boxes[:, 1] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 2])
+    area_sums = np.add.reduceat(areas, starts)
+    result = []
+    for start, end, area_sum in zip(starts, np.r_[starts[1:], len(image_ids)], area_sums):
+        image_id = int(image_ids[start])
+        if after is not None and image_id <= after:
+            continue
+        # the sum of (possibly overlapping) areas bounds the union from above, exact union only when needed
+        if area_sum > threshold and union_area(boxes[start:end]) > threshold:
+            result.append(image_id)
+            if len(result) == limit:
+                break
+    return result
@@ -0,0 +1,99 @@
+from array import array
+from bisect import bisect_left, bisect_right
+import threading
+from sqlalchemy import select
+import models
+
+
+# ------------------------ In-process inverted tag index ------------------------ #
+# tag -> sorted array of image ids (8 bytes per id, no per-object overhead like in a set).
+# Image ids come from an autoincrement key, so new ids are almost always appended at the end.
+# The index lives in the memory of a single process: it is rebuilt from link_tags on startup
+# and has to be updated by every endpoint that changes which tags an image has.
+# Writes of other processes are only picked up by reloading it (load + replace, see server.py).
+def _insert_sorted(ids, value):
+    if not ids or ids[-1] < value:
+        ids.append(value)
+        return
+    i = bisect_left(ids, value)
+    if i == len(ids) or ids[i] != value:
+        ids.insert(i, value)
+
+
+def _remove_sorted(ids, value):
+    i = bisect_left(ids, value)
+    if i < len(ids) and ids[i] == value:
+        del ids[i]
+
+
+def _intersect(smallest, others):
+    result = list(smallest)
+    for ids in others:
+        matched = []
+        lo = 0
+        for image_id in result:
+            # both sides are sorted, so the search window only moves forward
+            lo = bisect_left(ids, image_id, lo)
+            if lo == len(ids):
+                break
+            if ids[lo] == image_id:
+                matched.append(image_id)
+        result = matched
+        if not result:
+            break
+    return result
+
+
+class TagIndex:
+    def __init__(self):
+        self._postings = {}
+        self._all_ids = array('q')
+        self._lock = threading.Lock()
+
+    def rebuild(self, db):
+        self.replace(self.load(db))
+
+    @staticmethod
+    def load(db):
+        """The index built from the database, installed with replace()."""
+        postings = {}
+        rows = db.execute(
+            select(models.Tags.tag, models.image_tag_table.c.image_id)
+            .join(models.image_tag_table, models.image_tag_table.c.tag_id == models.Tags.id)
+            .order_by(models.image_tag_table.c.image_id))
+        for tag, image_id in rows:
+            _insert_sorted(postings.setdefault(tag, array('q')), image_id)
+        all_ids = array('q', db.execute(select(models.Images.id).order_by(models.Images.id)).scalars())
+        return postings, all_ids
+
+    def replace(self, loaded):
+        postings, all_ids = loaded
+        with self._lock:
+            self._postings = postings
+            self._all_ids = all_ids
+
+    def add_image(self, image_id, tags):
+        with self._lock:
+            _insert_sorted(self._all_ids, image_id)
+            for tag in set(tags):
+                _insert_sorted(self._postings.setdefault(tag, array('q')), image_id)
+
+    def remove_image(self, image_id, tags):
+        with self._lock:
+            _remove_sorted(self._all_ids, image_id)
+            for tag in set(tags):
+                ids = self._postings.get(tag)
+                if ids is not None:
+                    _remove_sorted(ids, image_id)
+
+    def image_ids(self, tags, after=None):
+        """Sorted ids of images that have ALL the given tags (all images for no tags), only ids > after."""
+        with self._lock:
+            if not tags:
+                result = list(self._all_ids)
+            else:
+                postings = sorted((self._postings.get(tag, array('q')) for tag in set(tags)), key=len)
+                result = _intersect(postings[0], postings[1:])
+        if after is not None:
+            result = result[bisect_right(result, after):]
+        return result
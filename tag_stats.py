@@ -0,0 +1,124 @@
+from bisect import bisect_left
+from heapq import nsmallest
+from itertools import combinations, groupby
+import sys
+import threading
+from sqlalchemy import select
+import models
+
+
+# ------------------------ Precomputed tag statistics ------------------------ #
+# Per tag the number of images having it, and a sparse co-occurrence matrix: tag -> {other tag -> number of
+# images having both} (symmetric, pairs that never occur together aren't stored).
+# Like TagIndex it lives in the memory of one process, is rebuilt from link_tags on startup (and reloaded when
+# other processes write images) and updated after the commit of every write that changes which tags an image has,
+# so the reads never touch the database.
+# The ranking by count is sorted once after a change and reused until the next one; tag names are also kept
+# sorted, a prefix is then a bisect range.
+def _prefix_end(prefix):
+    # the first string after every string starting with prefix, None when there's no such string
+    # (trailing maximal code points can't be incremented, the character before them is)
+    stripped = prefix.rstrip(chr(sys.maxunicode))
+    if not stripped:
+        return None
+    return stripped[:-1] + chr(ord(stripped[-1]) + 1)
+
+
+def _by_count(item):
+    # most images first, ties by name
+    return -item[1], item[0]
+
+
+class TagStats:
+    def __init__(self):
+        self._counts = {}
+        self._related = {}
+        self._names = []
+        self._ranking = None
+        self._lock = threading.Lock()
+
+    def rebuild(self, db):
+        self.replace(self.load(db))
+
+    @classmethod
+    def load(cls, db):
+        """The statistics computed from the database, installed with replace()."""
+        counts, related = {}, {}
+        rows = db.execute(
+            select(models.image_tag_table.c.image_id, models.Tags.tag)
+            .join(models.Tags, models.Tags.id == models.image_tag_table.c.tag_id)
+            .order_by(models.image_tag_table.c.image_id))
+        for _, group in groupby(rows, key=lambda row: row[0]):
+            cls._count(counts, related, {tag for _, tag in group}, 1)
+        return counts, related
+
+    def replace(self, loaded):
+        counts, related = loaded
+        with self._lock:
+            self._counts = counts
+            self._related = related
+            self._names = sorted(counts)
+            self._ranking = None
+
+    @staticmethod
+    def _count(counts, related, tags, delta):
+        """Adds delta to the counts of the tags and of every pair of them, returns the tags that appeared/vanished."""
+        changed = []
+        for tag in tags:
+            count = counts.get(tag, 0) + delta
+            if count > 0:
+                counts[tag] = count
+                if count == delta:
+                    changed.append(tag)
+            else:
+                counts.pop(tag, None)
+                related.pop(tag, None)
+                changed.append(tag)
+        for first, second in combinations(tags, 2):
+            for tag, other in ((first, second), (second, first)):
+                if tag not in counts:
+                    continue
+                others = related.setdefault(tag, {})
+                count = others.get(other, 0) + delta
+                if count > 0:
+                    others[other] = count
+                else:
+                    others.pop(other, None)
+        return changed
+
+    def _apply(self, tags, delta):
+        with self._lock:
+            for tag in self._count(self._counts, self._related, set(tags), delta):
+                i = bisect_left(self._names, tag)
+                if tag in self._counts:
+                    self._names.insert(i, tag)
+                elif i < len(self._names) and self._names[i] == tag:
+                    del self._names[i]
+            self._ranking = None
+
+    def add_image(self, tags):
+        if tags:
+            self._apply(tags, 1)
+
+    def remove_image(self, tags):
+        if tags:
+            self._apply(tags, -1)
+
+    def top(self, limit, prefix=""):
+        """[(tag, number of images)] of the most used tags (starting with prefix), most images first."""
+        with self._lock:
+            if prefix:
+                end = _prefix_end(prefix)
+                names = self._names[bisect_left(self._names, prefix):
+                                    len(self._names) if end is None else bisect_left(self._names, end)]
+                return nsmallest(limit, ((name, self._counts[name]) for name in names), key=_by_count)
+            if self._ranking is None:
+                self._ranking = sorted(self._counts.items(), key=_by_count)
+            return self._ranking[:limit]
+
+    def related(self, tag, limit):
+        """[(other tag, number of images having both)] most frequent first, None for an unknown tag."""
+        with self._lock:
+            if tag not in self._counts:
+                return None
+            return nsmallest(limit, self._related.get(tag, {}).items(), key=_by_count)